@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ---- System libraries --------------------------------------------------------
+import os
+import json
+import time
+import copy
+import argparse
+import tempfile
+import tracemalloc
+
+# ---- Third-party libraries ---------------------------------------------------
+import numpy as np
+
+# ---- Project libraries -------------------------------------------------------
+from conll import iter_trees_conll, iter_arrays_conll, UPOS
+from stats import tree_stats, sentence_stats, corpus_stats, PARSERS
+from vectorize import normalize
+import dictutils as du
+
+
+def generate_conll(path_to_file, sentences=1000, length=20, depth=6, rels=30, postags=17, seed=0):
+    """
+    Write a synthetic CoNLL-U corpus of random trees.
+
+    :param path_to_file: Path of the conll file to write
+    :param sentences: number of sentences
+    :param length: mean sentence length (lengths vary from length/2 to 3*length/2)
+    :param depth: maximal depth of the trees
+    :param rels: number of distinct relations (besides root)
+    :param postags: number of distinct POS tags
+    :param seed: seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    rel_labels = ['rel{}'.format(i) for i in range(rels)]
+    pos_labels = [UPOS[i] if i < len(UPOS) else 'X{}'.format(i) for i in range(postags)]
+    with open(path_to_file, 'w', encoding='utf-8') as conll:
+        for s in range(sentences):
+            n = int(rng.integers(max(1, length // 2), length * 3 // 2 + 1))
+            # Random tree: every node is attached to an earlier node that is not too deep
+            parents = [-1]
+            levels = [0]
+            for i in range(1, n):
+                candidates = [j for j in range(i) if levels[j] < depth]
+                parents.append(int(rng.choice(candidates)))
+                levels.append(levels[parents[-1]] + 1)
+            # Random linear order
+            order = rng.permutation(n)
+            position = {node: int(p) + 1 for node, p in zip(range(n), order)}
+            words = sorted(range(n), key=position.get)
+            print('# sent_id = synthetic-{}'.format(s), file=conll)
+            if rng.random() < 0.1 and n > 1:
+                print('1-2\tw1w2\t_\t_\t_\t_\t_\t_\t_\t_', file=conll) # multiword token
+            for node in words:
+                head = position[parents[node]] if parents[node] >= 0 else 0
+                rel = 'root' if head == 0 else rel_labels[rng.integers(rels)]
+                pos = pos_labels[rng.integers(postags)]
+                print('{}\tw{}\tw{}\t{}\t_\t_\t{}\t{}\t_\t_'.format(position[node], node, node, pos, head, rel), file=conll)
+            print(file=conll)
+
+
+def measure(function, repeat=3):
+    """
+    Run function repeat times and return the best wall time (in seconds),
+    then once more under tracemalloc to get its peak memory (in bytes).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(path_to_file, corpora=20, repeat=3):
+    """
+    Time the pipeline stages on a CoNLL file. normalize and to_vectors run
+    on corpora variants of its statistics (each missing some labels).
+    Returns {stage: {'items', 'unit', 'seconds', 'per_second', 'peak_mb'}}.
+    """
+    trees = list(iter_trees_conll(path_to_file))
+    sentences = list(iter_arrays_conll(path_to_file))
+    size = len(sentences)
+    stats = corpus_stats(sentences)
+    rng = np.random.default_rng(0)
+    variants = []
+    for _ in range(corpora):
+        variant = copy.deepcopy(stats)
+        for key in ['rels', 'postags']:
+            for label in list(variant[key]):
+                if rng.random() < 0.2:
+                    del variant[key][label]
+        variants.append(variant)
+
+    def normalized():
+        corpora = copy.deepcopy(variants)
+        normalize(corpora)
+        return corpora
+    normalized_variants = normalized()
+
+    stages = [
+        ('parse (conllu)', size, 'sentences', lambda: sum(1 for _ in iter_trees_conll(path_to_file))),
+        ('parse (fast)', size, 'sentences', lambda: sum(1 for _ in iter_arrays_conll(path_to_file))),
+        ('tree_stats', size, 'sentences', lambda: [tree_stats(tree) for tree in trees]),
+        ('sentence_stats', size, 'sentences', lambda: [sentence_stats(s) for s in sentences]),
+        ('corpus_stats (conllu)', size, 'sentences', lambda: corpus_stats(PARSERS['conllu'](path_to_file))),
+        ('corpus_stats (fast)', size, 'sentences', lambda: corpus_stats(PARSERS['fast'](path_to_file))),
+        ('normalize', corpora, 'corpora', normalized),
+        ('to_vectors', corpora, 'corpora', lambda: du.to_vectors(normalized_variants)),
+    ]
+    results = {}
+    for name, items, unit, function in stages:
+        seconds, peak = measure(function, repeat)
+        results[name] = {'items': items, 'unit': unit, 'seconds': seconds,
+                         'per_second': items / seconds, 'peak_mb': peak / 2**20}
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Print the results next to a baseline. Stages whose throughput dropped
+    (or peak memory grew) by more than threshold are flagged.
+    """
+    print('{:24} {:>14} {:>10} {:>9} {:>9}'.format('stage', 'items/s', 'peak MB', 'speed', 'memory'))
+    for name, r in results.items():
+        line = '{:24} {:>14.1f} {:>10.2f}'.format(name, r['per_second'], r['peak_mb'])
+        b = baseline.get(name)
+        if b:
+            speed = r['per_second'] / b['per_second'] - 1
+            memory = r['peak_mb'] / b['peak_mb'] - 1 if b['peak_mb'] else 0
+            line += ' {:>+8.1%} {:>+8.1%}'.format(speed, memory)
+            if speed < -threshold or memory > threshold:
+                line += '  REGRESSION'
+        print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the stats and vectorization pipeline.')
+    parser.add_argument('--file', help='CoNLL file to use instead of a synthetic corpus')
+    parser.add_argument('-n', '--sentences', type=int, default=1000, help='number of synthetic sentences')
+    parser.add_argument('-l', '--length', type=int, default=20, help='mean length of the synthetic sentences')
+    parser.add_argument('-d', '--depth', type=int, default=6, help='maximal depth of the synthetic trees')
+    parser.add_argument('--rels', type=int, default=30, help='number of synthetic relations')
+    parser.add_argument('--postags', type=int, default=17, help='number of synthetic POS tags')
+    parser.add_argument('-c', '--corpora', type=int, default=20, help='number of corpora to normalize and vectorize')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of runs (the best one is kept)')
+    parser.add_argument('-b', '--baseline', default='bench-baseline.json', help='baseline file to compare with')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    args = parser.parse_args()
+
+    config = {k: v for k, v in vars(args).items() if k not in ['repeat', 'baseline', 'save']}
+    if args.file:
+        results = run_benchmarks(args.file, args.corpora, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'synthetic.conllu')
+            generate_conll(path, args.sentences, args.length, args.depth, args.rels, args.postags)
+            results = run_benchmarks(path, args.corpora, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf8') as f:
+            saved = json.load(f)
+        if saved['config'] == config:
+            baseline = saved['results']
+        else:
+            print('Baseline {} was run with other settings: {}'.format(args.baseline, saved['config']))
+    compare(results, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf8') as f:
+            json.dump({'config': config, 'results': results}, f, indent=1)
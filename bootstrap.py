@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ---- System libraries --------------------------------------------------------
+import os
+import json
+import argparse
+import itertools
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+# ---- Third-party libraries ---------------------------------------------------
+import numpy as np
+import scipy.sparse
+
+# ---- Project libraries -------------------------------------------------------
+from stats import PARSERS, STATS_VERSION, any_tree_stats, manifest_entry
+from conll import conll_stem, conll_files
+import dictutils as du
+
+
+# Lists of values per label, summed as histograms {value: count}
+HISTOGRAMS = ['branches', 'length', 'thickness']
+
+
+def sentence_entries(stats):
+    """
+    Additive values of the statistics of one sentence (from tree_stats
+    or sentence_stats), as (path, value) pairs: summing them over a set of
+    sentences gives the totals kept by stats.CorpusAccumulator.
+    """
+    yield ('size',), 1
+    for k in ['weight', 'depth', 'mdd', 'mhd']:
+        yield (k,), stats[k]
+    for key in ['rels', 'postags']:
+        for label, dic in stats[key].items():
+            yield (key, label, 'count'), dic['count']
+            yield (key, label, 'sentences'), 1 # the sentence contains the label
+            yield (key, label, 'left'), dic['left']
+            yield (key, label, 'right'), dic['right']
+            for hist in HISTOGRAMS:
+                for value, n in Counter(dic[hist]).items():
+                    yield (key, label, hist, value), n # histogram bins
+            if key == 'rels':
+                for pair, n in dic['pospairs'].items():
+                    yield (key, label, 'pospairs', pair), n
+    for pair in {pair for dic in stats['rels'].values() for pair in dic['pospairs']}:
+        yield ('pospairs', pair), 1 # the sentence contains the POS pair
+
+
+def sentence_matrix(trees):
+    """
+    Precompute the statistics of every sentence as a sparse (sentences x
+    additive values) CSR matrix, described by a FeatureSchema (one path
+    per column, see sentence_entries). The totals of any sample of
+    sentences are then a product with a selection matrix.
+    """
+    index = {}
+    indptr, indices, data = [0], [], []
+    for tree in trees:
+        for path, value in sentence_entries(any_tree_stats(tree)):
+            if value:
+                i = index.get(path)
+                if i is None:
+                    i = index[path] = len(index)
+                indices.append(i)
+                data.append(value)
+        indptr.append(len(indices))
+    matrix = scipy.sparse.csr_matrix((np.array(data, dtype=float), np.array(indices, dtype=np.int64), indptr),
+                                     shape=(len(indptr) - 1, len(index)))
+    matrix.sort_indices()
+    return matrix, du.FeatureSchema(index)
+
+
+def save_sentence_matrix(name, matrix, schema, source=None):
+    """
+    Save a sentence matrix as <name>.npz, and its columns as <name>.json
+    along with the STATS_VERSION of the values and the manifest entry of
+    the corpus file it was computed from (source, see stats.manifest_entry).
+    """
+    scipy.sparse.save_npz(name + '.npz', matrix)
+    with open(name + '.json', 'w', encoding='utf8') as f:
+        json.dump({'version': STATS_VERSION, 'source': source,
+                   'columns': [[list(k) if isinstance(k, tuple) else k for k in path] for path in schema.columns]}, f)
+
+
+def load_sentence_matrix(name, path_to_file=None):
+    """
+    Load a sentence matrix saved by save_sentence_matrix. Returns (matrix,
+    schema), or None if it was saved by another version of the statistics
+    or, given the corpus file, if it was computed from another content.
+    """
+    with open(name + '.json', encoding='utf8') as f:
+        saved = json.load(f)
+    if not isinstance(saved, dict) or saved.get('version') != STATS_VERSION:
+        return None
+    if path_to_file is not None:
+        source = saved.get('source')
+        if not source or manifest_entry(path_to_file, source)['key'] != source['key']:
+            return None
+    schema = du.FeatureSchema(tuple(tuple(k) if isinstance(k, list) else k for k in path) for path in saved['columns'])
+    return scipy.sparse.load_npz(name + '.npz').tocsr(), schema
+
+
+def feature_layout(schema):
+    """
+    Columns of the additive values needed by each corpus feature:
+    {'globals': {name: column}, 'pospairs': {pair: column}, 'labels': {(key, label):
+    {'count', 'sentences', 'left', 'right': column, 'bins': {histogram: (values, columns)},
+    'pairs': (pairs, columns)}}}
+    """
+    layout = {'globals': {}, 'pospairs': {}, 'labels': {}}
+    for i, path in enumerate(schema.columns):
+        if len(path) == 1:
+            layout['globals'][path[0]] = i
+            continue
+        if path[0] == 'pospairs':
+            layout['pospairs'][path[1]] = i
+            continue
+        entry = layout['labels'].setdefault(path[:2], {'count': None, 'sentences': None, 'left': None, 'right': None,
+                                                       'bins': {hist: [] for hist in HISTOGRAMS}, 'pairs': []})
+        if path[2] in HISTOGRAMS:
+            entry['bins'][path[2]].append((path[3], i))
+        elif path[2] == 'pospairs':
+            entry['pairs'].append((path[3], i))
+        else:
+            entry[path[2]] = i
+    def split(pairs):
+        pairs = sorted(pairs)
+        return [x for x, _ in pairs], np.array([i for _, i in pairs], dtype=np.intp)
+    for entry in layout['labels'].values():
+        entry['bins'] = {hist: split(bins) for hist, bins in entry['bins'].items()}
+        entry['pairs'] = split(entry['pairs'])
+    return layout
+
+
+def describe_bins(values, counts):
+    """
+    describe_hist of many histograms at once: counts is a (samples x bins)
+    array of the counts of the (sorted) values. Empty histograms get 0
+    for every statistic (as absent labels in vectorize.normalize).
+    """
+    values = np.asarray(values, dtype=float)
+    n = counts.sum(axis=1)
+    safe_n = np.where(n > 0, n, 1)
+    mean = counts @ values / safe_n
+    dev = values[None, :] - mean[:, None]
+    m2 = (counts * dev ** 2).sum(axis=1) / safe_n
+    m3 = (counts * dev ** 3).sum(axis=1) / safe_n
+    m4 = (counts * dev ** 4).sum(axis=1) / safe_n
+
+    cumcounts = np.cumsum(counts, axis=1)
+    def quantile(q):
+        pos = q * (n - 1)
+        lo, hi = np.floor(pos), np.ceil(pos)
+        i_lo = np.minimum((cumcounts <= lo[:, None]).sum(axis=1), len(values) - 1)
+        i_hi = np.minimum((cumcounts <= hi[:, None]).sum(axis=1), len(values) - 1)
+        return values[i_lo] + (pos - lo) * (values[i_hi] - values[i_lo])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = {}
+        d['mean'] = mean
+        d['median'] = quantile(0.5)
+        d['std'] = np.sqrt(m2)
+        d['range'] = quantile(0.75) - quantile(0.25)
+        d['skew'] = np.where(m2 > 0, m3 / m2 ** 1.5, np.nan)
+        d['kurtosis'] = np.where(m2 > 0, m4 / m2 ** 2 - 3, np.nan)
+    for k in d:
+        d[k] = np.where(n > 0, d[k], 0)
+    return d
+
+
+def derive(sums, layout):
+    """
+    Corpus features (as stats.CorpusAccumulator.finalize, with the absent
+    labels set to 0 as in vectorize.normalize) of many samples at once,
+    from their (samples x additive values) totals.
+    Returns {feature path: array of the values of the samples}.
+    """
+    g = layout['globals']
+    size = sums[:, g['size']]
+    weight = sums[:, g['weight']]
+    features = {}
+    for k in ['mdd', 'mhd', 'depth', 'weight']:
+        features[(k,)] = sums[:, g[k]] / size
+    for pair, i in layout['pospairs'].items():
+        features[('pospairs', pair)] = sums[:, i] / size
+    for (key, label), entry in layout['labels'].items():
+        count = sums[:, entry['count']]
+        left = sums[:, entry['left']] if entry['left'] is not None else np.zeros(len(sums))
+        right = sums[:, entry['right']] if entry['right'] is not None else np.zeros(len(sums))
+        branches = left + right
+        safe = np.where(branches > 0, branches, 1)
+        features[(key, label, 'freq')] = count / weight
+        features[(key, label, 'coverage')] = sums[:, entry['sentences']] / size
+        features[(key, label, 'branches', 'left')] = np.where(branches > 0, left / safe, 0)
+        features[(key, label, 'branches', 'right')] = np.where(branches > 0, right / safe, 0)
+        for hist, (values, columns) in entry['bins'].items():
+            path = (key, label, 'branches', 'dist') if hist == 'branches' else (key, label, hist)
+            for stat, v in describe_bins(values, sums[:, columns]).items():
+                features[path + (stat,)] = v
+        if key == 'rels':
+            pairs, columns = entry['pairs']
+            counts = sums[:, columns]
+            total = counts.sum(axis=1, keepdims=True)
+            shares = counts / np.where(total > 0, total, 1)
+            for pair, v in zip(pairs, shares.T):
+                features[(key, label, 'pospairs', pair)] = v
+    return features
+
+
+def selection_matrix(n, samples, size, replace=False, rng=None):
+    """
+    Sparse (samples x n) matrix whose rows count how many times each of
+    the n sentences is drawn in a sample of size sentences.
+    """
+    rng = np.random.default_rng(rng)
+    if replace:
+        cols = rng.integers(0, n, (samples, size)).ravel()
+    else:
+        cols = np.concatenate([rng.choice(n, size, replace=False) for _ in range(samples)])
+    rows = np.repeat(np.arange(samples), size)
+    return scipy.sparse.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(samples, n))
+
+
+def bootstrap(matrix, schema, samples=1000, size=1000, replace=False, seed=None, batch=100):
+    """
+    Draw samples random samples of size sentences from a sentence matrix
+    and compute the corpus features of every sample, batch samples at a
+    time (one sparse product per batch).
+    Returns (feature paths, values of the whole corpus, samples x features array).
+    """
+    n = matrix.shape[0]
+    if not replace and size > n:
+        raise ValueError('corpus smaller than the samples ({} < {} sentences)'.format(n, size))
+    layout = feature_layout(schema)
+    full = derive(np.asarray(matrix.sum(axis=0)), layout)
+    paths = list(full)
+    rng = np.random.default_rng(seed)
+    values = np.empty((samples, len(paths)))
+    for start in range(0, samples, batch):
+        stop = min(start + batch, samples)
+        sums = (selection_matrix(n, stop - start, size, replace, rng) @ matrix).toarray()
+        derived = derive(sums, layout)
+        for j, path in enumerate(paths):
+            values[start:stop, j] = derived[path]
+    return paths, np.array([full[path][0] for path in paths]), values
+
+
+def confidence_intervals(values, confidence=0.95):
+    """Mean, std and percentile interval of each column (NaN values ignored)"""
+    alpha = (1 - confidence) / 2 * 100
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanpercentile(values, [alpha, 100 - alpha], axis=0)
+        return np.nanmean(values, axis=0), np.nanstd(values, axis=0), low, high
+
+
+def process_corpus(lng, path_to_file, outpath, parser='conllu', samples=1000, size=1000,
+                   replace=False, confidence=0.95, seed=0):
+    """
+    Bootstrap the features of a corpus and save them as a table
+    <lng>.bootstrap.tsv (feature, corpus value, mean, std, low, high).
+    The sentence matrix is saved as <lng>.bootstrap.npz/.json, and only
+    computed again when the content of the corpus file or the statistics
+    changed (see stats.manifest_entry and stats.STATS_VERSION).
+    Returns (lng, summary, error), as stats.process_corpus.
+    """
+    name = os.path.join(outpath, lng + '.bootstrap')
+    try:
+        cached = None
+        if os.path.exists(name + '.npz') and os.path.exists(name + '.json'):
+            cached = load_sentence_matrix(name, path_to_file)
+        if cached is None:
+            cached = sentence_matrix(PARSERS[parser](path_to_file))
+            save_sentence_matrix(name, *cached, source=manifest_entry(path_to_file))
+        matrix, schema = cached
+        paths, full, values = bootstrap(matrix, schema, samples, size, replace, seed)
+    except ValueError as err:
+        return lng, None, str(err)
+    except Exception as err:
+        return lng, None, "can't process the corpus for {} ({}: {})".format(lng, type(err).__name__, err)
+
+    mean, std, low, high = confidence_intervals(values, confidence)
+    with open(name + '.tsv', 'w', encoding='utf8') as f:
+        print('feature\tvalue\tmean\tstd\tlow\thigh', file=f)
+        for row in zip(du.FeatureSchema(paths).names, full, mean, std, low, high):
+            print('\t'.join(map(str, row)), file=f)
+    with np.errstate(invalid='ignore'):
+        outside = (full < low) | (full > high)
+    summary = {'sentences': matrix.shape[0], 'features': len(paths),
+               'outside': int(outside.sum()), 'mean_width': float(np.nanmean(high - low))}
+    return lng, summary, None
+
+
+# TEST ROUTINES
+# ===================================================================
+
+def test_bootstrap():
+    from stats import TEST_PATH, corpus_stats
+    from conll import SentenceIndex
+    path = os.path.join(TEST_PATH, 'fr_ftb-ud-dev.conllu')
+    with SentenceIndex(path, save=False) as index:
+        sentences = index.arrays(range(len(index)))
+        matrix, schema = sentence_matrix(sentences)
+        layout = feature_layout(schema)
+        rng = np.random.default_rng(0)
+        for rows in [np.arange(len(index)), rng.choice(len(index), 50, replace=False)]:
+            features = derive(np.asarray(matrix[rows].sum(axis=0)), layout)
+            expected = dict(du.leaves(corpus_stats([sentences[i] for i in rows])))
+            for path, value in expected.items():
+                assert np.isclose(features[path][0], value, equal_nan=True), (path, features[path][0], value)
+            # Labels absent from the sample are 0
+            assert all(features[path][0] == 0 or np.isnan(features[path][0]) for path in features if path not in expected)
+    paths, full, values = bootstrap(matrix, schema, samples=30, size=100, seed=0, batch=7)
+    assert values.shape == (30, len(paths))
+    mean, std, low, high = confidence_intervals(values)
+    assert np.all((low <= mean) | np.isnan(mean))
+
+def test_cache():
+    import tempfile
+    from stats import TEST_PATH
+    path = os.path.join(TEST_PATH, 'test1.conllu')
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, 'xx.bootstrap')
+        matrix, schema = sentence_matrix(PARSERS['fast'](path))
+        save_sentence_matrix(name, matrix, schema)
+        cached, cached_schema = load_sentence_matrix(name)
+        assert (cached != matrix).nnz == 0 and cached_schema.columns == schema.columns
+        # A matrix saved by an older version of the statistics (columns only) is computed again
+        old = [path for path in schema.columns if 'sentences' not in path]
+        save_sentence_matrix(name, matrix[:, :len(old)], du.FeatureSchema(old))
+        du.FeatureSchema(old).save(name + '.json')
+        assert load_sentence_matrix(name) is None
+        _, summary, error = process_corpus('xx', path, tmp, 'fast', samples=5, size=100)
+        assert error is None and summary['features'] > 0
+        assert load_sentence_matrix(name)[1].columns == schema.columns
+        # A replaced corpus is computed again, even if the new file is older
+        import shutil
+        copy = shutil.copy(path, os.path.join(tmp, 'xx.conllu'))
+        _, summary, _ = process_corpus('xx', copy, tmp, 'fast', samples=5, size=100)
+        stat = os.stat(copy)
+        shutil.copy(os.path.join(TEST_PATH, 'test2.conllu'), copy)
+        os.utime(copy, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+        _, replaced, _ = process_corpus('xx', copy, tmp, 'fast', samples=5, size=100)
+        assert replaced['sentences'] == sum(1 for _ in PARSERS['fast'](copy)) != summary['sentences']
+
+
+def test():
+    test_bootstrap()
+    test_cache()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Bootstrap the corpus features from samples of sentences of fixed size.')
+    parser.add_argument('-i', '--inpath', default='data-test/', help='path where the corpora reside')
+    parser.add_argument('-o', '--outpath', default='data-test/', help='path where the results should be saved')
+    parser.add_argument('-p', '--parser', default='fast', choices=sorted(PARSERS), help='parser backend')
+    parser.add_argument('-n', '--samples', type=int, default=1000, help='number of samples per corpus')
+    parser.add_argument('-k', '--size', type=int, default=1000, help='number of sentences per sample')
+    parser.add_argument('-r', '--replace', action='store_true', help='draw the sentences with replacement')
+    parser.add_argument('-c', '--confidence', type=float, default=0.95, help='confidence level of the intervals')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random draws')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of corpora processed in parallel')
+    args = parser.parse_args()
+
+    files = conll_files(os.listdir(args.inpath)) # plain or compressed, one per corpus
+    languages = [conll_stem(f) for f in files]
+
+    with ProcessPoolExecutor(args.jobs) if args.jobs > 1 else nullcontext() as pool:
+        run = pool.map if pool else map
+        results = run(process_corpus, languages, [os.path.join(args.inpath, f) for f in files],
+                      itertools.repeat(args.outpath), itertools.repeat(args.parser),
+                      itertools.repeat(args.samples), itertools.repeat(args.size), itertools.repeat(args.replace),
+                      itertools.repeat(args.confidence), itertools.repeat(args.seed))
+        for lng, summary, error in results:
+            print('Processing', lng)
+            if error is not None:
+                print('  SKIPPING: ' + error)
+                continue
+            print('  {sentences} sentences, {features} features, {outside} outside their interval, '
+                  'mean interval width {mean_width:.4f}'.format(**summary))
@@ -1,22 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import numpy as np
-import pickle
 from scipy.cluster.hierarchy import dendrogram, linkage
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
 from matplotlib import pyplot as plt
 from pprint import pprint
 
+from vectorize import load_matrix
+from distances import distance_matrix
+
 if __name__ == "__main__":
-    file = 'stats.pickle'
-    with open(file, 'rb') as f:
-        data = pickle.load(f)
-    # Leave out the ones with wrong vector length
-    data = {k:v for k,v in data.items() if len(v) == 12779}
-    X = np.vstack(data.values())
-    languages = list(data.keys())
+    # Memory-mapped float32 matrix (see vectorize.save_matrix and vectorize.convert_pickle)
+    X, languages, columns = load_matrix('data-test/vectors-all')
 
     # 2D projection
     pca = PCA(n_components=2, whiten=True)
@@ -29,7 +25,7 @@ if __name__ == "__main__":
     plt.savefig('scatter.png')
 
     # Dendrogram
-    Z = linkage(X, 'single')
+    Z = linkage(distance_matrix('data-test/vectors-all'), 'single') # cached distances
     fig = plt.figure(figsize=(12, 10))
     dn = dendrogram(Z, labels=languages)
     fig.savefig('dendrogram.png')
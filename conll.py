@@ -2,12 +2,191 @@
 # -*- coding: utf-8 -*-
 
 # ---- System libraries --------------------------------------------------------
+import io
+import os
 import re
+import json
+import gzip
+import lzma
+import mmap
+import queue
+import codecs
+import itertools
+import threading
+from collections import namedtuple
 
 # ---- Third-party libraries ---------------------------------------------------
+import numpy as np
 from conllu import parse
 from conllu import parse_tree
 
+try:
+    import zstandard
+except ImportError: # .zst files cannot be read
+    zstandard = None
+
+
+# Universal POS tags, so that their codes are the same in every corpus
+UPOS = ('ADJ', 'ADP', 'ADV', 'AUX', 'CCONJ', 'DET', 'INTJ', 'NOUN', 'NUM',
+        'PART', 'PRON', 'PROPN', 'PUNCT', 'SCONJ', 'SYM', 'VERB', 'X')
+
+# A sentence as parallel arrays (one cell per word, in linear order)
+# ids, heads: int32 arrays (head 0 is the root)
+# upos, deprels: int16 codes, decoded by upos_labels and deprel_labels
+Sentence = namedtuple('Sentence', ['ids', 'heads', 'upos', 'deprels',
+                                   'upos_labels', 'deprel_labels'])
+
+
+class Codebook(dict):
+    """
+    Map labels to small integer codes, assigned in order of appearance.
+    codebook[label] returns the code of label (creating it if needed)
+    and codebook.labels[code] returns the label back.
+    """
+    def __init__(self, labels=()):
+        super().__init__()
+        self.labels = []
+        for label in labels:
+            self[label]
+
+    def __missing__(self, label):
+        code = self[label] = len(self.labels)
+        self.labels.append(label)
+        return code
+
+
+def open_zstd(path_to_file: str, mode: str='rb'):
+    if zstandard is None:
+        raise ValueError('the zstandard package is needed to read ' + os.path.basename(path_to_file))
+    return zstandard.ZstdDecompressor().stream_reader(open(path_to_file, 'rb'), read_across_frames=True, closefd=True)
+
+
+# Compressed CoNLL files: suffix and function opening them (binary mode)
+COMPRESSED = {'.gz': gzip.open, '.xz': lzma.open, '.zst': open_zstd}
+
+# Suffixes of CoNLL files, plain or compressed
+CONLL_SUFFIXES = ('.conllu',) + tuple('.conllu' + suffix for suffix in COMPRESSED)
+
+
+def is_compressed(path_to_file: str)->bool:
+    return path_to_file.endswith(tuple(COMPRESSED))
+
+
+def is_conll_file(path_to_file: str)->bool:
+    return path_to_file.endswith(CONLL_SUFFIXES)
+
+
+def conll_stem(file: str)->str:
+    """File name without the .conllu suffix (and compression suffix)"""
+    for suffix in CONLL_SUFFIXES:
+        if file.endswith(suffix):
+            return file[:-len(suffix)]
+    return file
+
+
+def conll_files(files)->list:
+    """
+    The CoNLL files (plain or compressed) among file names, sorted, with
+    one file per corpus: a plain file is preferred to its compressed
+    copies (e.g. fr.conllu to fr.conllu.gz), which would otherwise be
+    read as corpora of the same name.
+    """
+    chosen = {}
+    for file in files:
+        if is_conll_file(file):
+            stem = conll_stem(file)
+            if stem not in chosen or CONLL_SUFFIXES.index(file[len(stem):]) < CONLL_SUFFIXES.index(chosen[stem][len(stem):]):
+                chosen[stem] = file
+    return sorted(chosen.values())
+
+
+def open_conll(path_to_file: str):
+    """
+    Open a CoNLL file in binary mode, decompressing it
+    on the fly if it is compressed (see COMPRESSED).
+    """
+    for suffix, opener in COMPRESSED.items():
+        if path_to_file.endswith(suffix):
+            return opener(path_to_file, 'rb')
+    return open(path_to_file, 'rb')
+
+
+def decompressed_chunks(path_to_file: str, chunk_size: int=1 << 20, buffers: int=8):
+    """
+    Decompress a file in a background thread and yield its content
+    chunk by chunk, so that decompression (which releases the GIL)
+    overlaps with the processing of the previous chunks. At most
+    buffers chunks are decompressed ahead.
+    
+    :param path_to_file: Path to the compressed file
+    :param chunk_size: number of decompressed bytes per chunk
+    :param buffers: size of the queue between the thread and the reader
+    :returns: a generator of chunks of bytes
+    """
+    chunks = queue.Queue(buffers)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False # the reader stopped
+
+    def decompress():
+        try:
+            with open_conll(path_to_file) as conll:
+                for chunk in iter(lambda: conll.read(chunk_size), b''):
+                    if not put(chunk):
+                        return
+            put(None)
+        except Exception as err: # raised again in the reader
+            put(err)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_chunks(path_to_file: str, chunk_size: int=1 << 20, start: int=0, end: int=None):
+    """
+    Read a file (or a byte range of it) chunk by chunk. Compressed files
+    are decompressed in a background thread (see decompressed_chunks),
+    and can only be read as a whole.
+    
+    :param path_to_file: Path to the file
+    :param chunk_size: number of bytes read at once
+    :param start: byte offset where reading starts
+    :param end: byte offset where reading stops (None: end of file)
+    :returns: a generator of chunks of bytes
+    """
+    if is_compressed(path_to_file):
+        if start != 0 or end is not None:
+            raise ValueError("can't read a byte range of compressed file " + os.path.basename(path_to_file))
+        yield from decompressed_chunks(path_to_file, chunk_size)
+        return
+    with open(path_to_file, 'rb') as conll:
+        conll.seek(start)
+        remaining = float('inf') if end is None else end - start
+        while remaining > 0:
+            data = conll.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
 
 def load_conll(path_to_file: str)->str:
     """
@@ -18,7 +197,7 @@ def load_conll(path_to_file: str)->str:
     :param path_to_file: Path to the conll file
     :returns: the file content as a single string
     """
-    with open(path_to_file, 'r', encoding='utf-8', errors='ignore') as conll:
+    with io.TextIOWrapper(open_conll(path_to_file), encoding='utf-8', errors='ignore') as conll:
         lines = [line for line in conll.readlines() 
                  if not re.search(r'\d+-\d+', line)]
     return ''.join(lines)
@@ -47,7 +226,324 @@ def parse_tree_conll(path_to_file: str)->list:
     """
     
     return parse_tree(load_conll(path_to_file))
+
+
+def is_word_line(line: str)->bool:
+    """
+    Tell whether a CoNLL line holds a syntactic word, i.e. it is
+    neither a multiword token (ID "3-4") nor an empty node (ID "5.1").
+    Comment and blank lines are considered word lines.
     
+    :param line: a line of a CoNLL file
+    :returns: False for multiword tokens and empty nodes, True otherwise
+    """
+    if line.startswith('#'):
+        return True
+    index = line.split('\t', 1)[0]
+    return '-' not in index and '.' not in index
+
+
+def iter_blocks_conll(path_to_file: str, chunk_size: int=1 << 20,
+                      start: int=0, end: int=None):
+    """
+    Read a CoNLL file in chunks and yield one sentence at a time
+    as a list of lines (comments included, line breaks stripped).
+    Skip lines containing multiword tokens and empty nodes.
+    Only one sentence (plus one chunk) is held in memory at a time.
+    Compressed files are decompressed on the fly (see read_chunks).
+    
+    :param path_to_file: Path to the conll file
+    :param chunk_size: number of bytes read from the file at once
+    :param start: byte offset where reading starts (a sentence boundary)
+    :param end: byte offset where reading stops (None: end of file)
+    :returns: a generator of sentences as lists of CoNLL lines
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    sentence = []
+    rest = ''
+    for data in itertools.chain(read_chunks(path_to_file, chunk_size, start, end), [b'']):
+        chunk = decoder.decode(data, final=not data)
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop() if data else ''
+        for line in lines:
+            line = line.rstrip('\r')
+            if line.strip():
+                if is_word_line(line):
+                    sentence.append(line)
+            elif sentence:
+                yield sentence
+                sentence = []
+    if sentence:
+        yield sentence
+
+
+# Sentence index of a CoNLL file: byte range of each sentence (from its
+# first line to the end of its last line) and number of syntactic words
+INDEX_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'), ('tokens', '<i4')])
+
+
+def index_path(path_to_file: str)->str:
+    """Path of the persisted sentence index of a CoNLL file"""
+    return path_to_file + '.idx.npy'
+
+
+def index_stamp(path_to_file: str)->dict:
+    """
+    Size and modification time (in ns) of a CoNLL file, saved next to its
+    index (<file>.idx.json): the index is only reused if they are the same,
+    since a replaced file can be older than the index (e.g. with tar or cp -p).
+    """
+    stat = os.stat(path_to_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_index(path_to_file: str)->np.ndarray:
+    """
+    Scan a CoNLL file (memory-mapped) and index its sentences.
+    
+    :param path_to_file: Path to the conll file
+    :returns: an array of INDEX_DTYPE records, one per sentence
+    """
+    if is_compressed(path_to_file):
+        raise ValueError("can't index compressed file " + os.path.basename(path_to_file))
+    records = []
+    if os.path.getsize(path_to_file) == 0:
+        return np.array(records, dtype=INDEX_DTYPE)
+    with open(path_to_file, 'rb') as conll, mmap.mmap(conll.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = 0
+        start = end = tokens = None
+        for line in iter(mm.readline, b''):
+            if line.strip():
+                if start is None:
+                    start, tokens = position, 0
+                if line[:1].isdigit():
+                    index = line.split(b'\t', 1)[0]
+                    tokens += b'-' not in index and b'.' not in index
+                end = position + len(line)
+            elif start is not None:
+                records.append((start, end, tokens))
+                start = None
+            position += len(line)
+        if start is not None:
+            records.append((start, end, tokens))
+    return np.array(records, dtype=INDEX_DTYPE)
+
+
+def load_index(path_to_file: str, save: bool=True)->np.ndarray:
+    """
+    Load the sentence index of a CoNLL file (memory-mapped), building
+    it if it is missing or the file changed since (see index_stamp). The
+    index is saved next to the file (<file>.idx.npy) when possible.
+    
+    :param path_to_file: Path to the conll file
+    :param save: persist the index if it had to be built
+    :returns: an array of INDEX_DTYPE records, one per sentence
+    """
+    if is_compressed(path_to_file):
+        raise ValueError("can't index compressed file " + os.path.basename(path_to_file))
+    fn = index_path(path_to_file)
+    stamp_fn = fn[:-len('.npy')] + '.json'
+    stamp = index_stamp(path_to_file)
+    try:
+        with open(stamp_fn, encoding='utf8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+    if saved == stamp and os.path.exists(fn):
+        index = np.load(fn, mmap_mode='r')
+        if index.dtype == INDEX_DTYPE:
+            return index
+    index = build_index(path_to_file)
+    if save:
+        try:
+            # The stamp is replaced last, so that it never vouches for another index
+            np.save(fn + '.tmp.npy', index)
+            os.replace(fn + '.tmp.npy', fn)
+            with open(stamp_fn + '.tmp', 'w', encoding='utf8') as f:
+                json.dump(stamp, f)
+            os.replace(stamp_fn + '.tmp', stamp_fn)
+        except OSError: # e.g. read-only corpus directory
+            pass
+    return index
+
+
+def sentence_offsets(path_to_file: str)->np.ndarray:
+    """
+    Index the sentence boundaries of a CoNLL file (see load_index).
+    
+    :param path_to_file: Path to the conll file
+    :returns: the byte offsets where sentences start, followed by the file size
+    """
+    starts = load_index(path_to_file)['start']
+    return np.append(starts, os.path.getsize(path_to_file)).astype(np.int64)
+
+
+class SentenceIndex:
+    """
+    Random access to the sentences of a CoNLL file: sentence i, a range
+    of sentences or a random sample are read from the memory-mapped file
+    through its sentence index, without parsing the rest of the file.
+    index[i] returns sentence i as a CoNLL string (as iter_sentences_conll),
+    index[i:j] a list of them.
+    """
+
+    def __init__(self, path_to_file: str, save: bool=True):
+        self.path = path_to_file
+        self.records = load_index(path_to_file, save)
+        self.conll = open(path_to_file, 'rb')
+        self.mm = mmap.mmap(self.conll.fileno(), 0, access=mmap.ACCESS_READ) if len(self.records) else b''
+
+    def __len__(self):
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.conll.close()
+
+    @property
+    def tokens(self)->np.ndarray:
+        """Number of syntactic words of each sentence"""
+        return self.records['tokens']
+
+    def lines(self, i: int)->list:
+        """
+        Lines of sentence i (as iter_blocks_conll: comments included,
+        multiword tokens and empty nodes skipped)
+        """
+        start, end, _ = self.records[i]
+        text = self.mm[start:end].decode('utf-8', errors='ignore')
+        return [line.rstrip('\r') for line in text.split('\n')
+                if line.strip() and is_word_line(line.rstrip('\r'))]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return '\n'.join(self.lines(i)) + '\n\n'
+
+    def sample(self, k: int, seed=None, replace: bool=False)->tuple:
+        """
+        Draw a random sample of sentences.
+        
+        :param k: number of sentences
+        :param seed: seed (or numpy Generator) of the random draw
+        :param replace: draw with replacement
+        :returns: (indices, sentences as CoNLL strings), in file order
+        """
+        rng = np.random.default_rng(seed)
+        indices = np.sort(rng.choice(len(self), k, replace=replace))
+        return indices, [self[i] for i in indices]
+
+    def trees(self, indices)->list:
+        """Given sentences as TokenTree objects (as iter_trees_conll)"""
+        return [tree for i in indices for tree in parse_tree(self[i])]
+
+    def arrays(self, indices, upos: Codebook=None, deprels: Codebook=None, subtypes: bool=True)->list:
+        """Given sentences as Sentence objects (as iter_arrays_conll)"""
+        upos = Codebook(UPOS) if upos is None else upos
+        deprels = Codebook() if deprels is None else deprels
+        return [parse_arrays(self.lines(i), upos, deprels, subtypes) for i in indices]
+
+
+def shard_ranges(offsets: np.ndarray, shards: int)->list:
+    """
+    Split a CoNLL file into byte ranges of similar sizes,
+    cut at sentence boundaries.
+    
+    :param offsets: sentence offsets, as returned by sentence_offsets
+    :param shards: (maximal) number of ranges
+    :returns: a list of (start, end) byte offsets
+    """
+    targets = np.linspace(offsets[0], offsets[-1], shards + 1)
+    cuts = np.unique(offsets[np.searchsorted(offsets, targets)]).tolist()
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def iter_sentences_conll(path_to_file: str, start: int=0, end: int=None):
+    """
+    Read a CoNLL file in chunks and yield one sentence at a time.
+    Skip lines containing multiword tokens and empty nodes.
+    
+    :param path_to_file: Path to the conll file
+    :param start, end: byte range to read (see iter_blocks_conll)
+    :returns: a generator of sentences as CoNLL strings
+    """
+    for sentence in iter_blocks_conll(path_to_file, start=start, end=end):
+        yield '\n'.join(sentence) + '\n\n'
+
+
+def iter_trees_conll(path_to_file: str, start: int=0, end: int=None):
+    """
+    Read a CoNLL file sentence by sentence and yield
+    TokenTree objects one at a time, so that memory usage
+    does not depend on the size of the corpus.
+    
+    :param path_to_file: Path to the conll file
+    :param start, end: byte range to read (see iter_blocks_conll)
+    :returns: a generator of sentences as TokenTree objects
+    """
+    for sentence in iter_sentences_conll(path_to_file, start, end):
+        yield from parse_tree(sentence)
+
+
+def parse_arrays(lines: list, upos: Codebook, deprels: Codebook,
+                 subtypes: bool=True)->Sentence:
+    """
+    Parse the lines of one sentence, keeping only the ID, UPOS,
+    HEAD and DEPREL columns as compact arrays.
+    
+    :param lines: CoNLL lines of a sentence (without multiword tokens)
+    :param upos: codebook for POS tags (updated in place)
+    :param deprels: codebook for relations (updated in place)
+    :param subtypes: keep relation subtypes (e.g. "nmod:poss")
+    :returns: the sentence as a Sentence of arrays
+    """
+    ids, heads, tags, rels = [], [], [], []
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        cols = line.split('\t', 8)
+        if len(cols) < 8:
+            raise ValueError('malformed CoNLL line: {!r}'.format(line))
+        ids.append(cols[0])
+        heads.append(cols[6])
+        tags.append(upos[cols[3]])
+        rels.append(deprels[cols[7] if subtypes else cols[7].split(':')[0]])
+    try:
+        ids = np.array(ids, dtype=np.int32)
+        heads = np.array(heads, dtype=np.int32)
+    except ValueError:
+        raise ValueError('non-numerical ID or HEAD in sentence {!r}'.format(lines[0]))
+    return Sentence(ids, heads, np.array(tags, dtype=np.int16),
+                    np.array(rels, dtype=np.int16), upos.labels, deprels.labels)
+
+
+def iter_arrays_conll(path_to_file: str, upos: Codebook=None,
+                      deprels: Codebook=None, subtypes: bool=True,
+                      start: int=0, end: int=None):
+    """
+    Fast alternative to iter_trees_conll: read a CoNLL file sentence
+    by sentence and yield Sentence objects (ID, UPOS, HEAD and DEPREL
+    as arrays) instead of full TokenTree objects.
+    
+    :param path_to_file: Path to the conll file
+    :param upos: codebook for POS tags (a new one if None)
+    :param deprels: codebook for relations (a new one if None)
+    :param subtypes: keep relation subtypes (e.g. "nmod:poss")
+    :param start, end: byte range to read (see iter_blocks_conll)
+    :returns: a generator of sentences as Sentence objects
+    """
+    upos = Codebook(UPOS) if upos is None else upos
+    deprels = Codebook() if deprels is None else deprels
+    for lines in iter_blocks_conll(path_to_file, start=start, end=end):
+        yield parse_arrays(lines, upos, deprels, subtypes)
+
 
 if __name__ == "__main__":
     path = "data/fr_ftb-ud-dev.conllu"
@@ -62,4 +558,19 @@ if __name__ == "__main__":
     
     # Parse a CoNLL file as TokenTree objects
     corpus = parse_tree_conll(path)
-    print(corpus[1])
\ No newline at end of file
+    print(corpus[1])
+    
+    # Stream a CoNLL file one TokenTree at a time
+    for tree in iter_trees_conll(path):
+        print(tree)
+        break
+    
+    # Stream a CoNLL file as compact arrays
+    for sentence in iter_arrays_conll(path):
+        print(sentence)
+        break
+    
+    # Random access through the sentence index
+    with SentenceIndex(path) as index:
+        print(len(index), 'sentences')
+        print(index[1])
\ No newline at end of file
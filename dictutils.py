@@ -1,7 +1,9 @@
 import numpy as np
+import scipy.sparse
+import json
+import copy
 from pprint import pprint
 import collections.abc
-from collections import OrderedDict
 
 def keyset(dicts, typed=False):
     """
@@ -44,24 +46,60 @@ def normalize_values(d):
             values = values / n
         return dict(zip(d.keys(), values))
 
+def normalize_structure(dicts):
+    """
+    Recursively normalize the keys of a list of dictionaries, so that
+    they all have the same (nested) keys. Values are not modified.
+    """
+    # list of keys and types (missing numerical values of any type become 0)
+    keys = [(k, dict if any(isinstance(d.get(k), dict) for d in dicts) else int) for k in keyset(dicts)]
+    dicts = [normalize_keys(d, keys) for d in dicts] # make sure we have the same keys
+    for k,t in keys:
+        if t is dict:
+            normalize_structure([d[k] for d in dicts])
+    return dicts
+
+def set_values(dictionary, columns, values):
+    """Set the leaves of a dictionary at the given paths (tuples of keys)"""
+    for path, v in zip(columns, values):
+        d = dictionary
+        for k in path[:-1]:
+            d = d[k]
+        d[path[-1]] = v
+    return dictionary
+
+def minmax_columns(matrix):
+    """
+    Min-max scale every column of a (dicts x features) matrix to [0, 1].
+    Constant columns are set to 0.
+    """
+    if matrix.shape[0] == 0:
+        return matrix.astype(float)
+    mins = matrix.min(axis=0)
+    span = matrix.max(axis=0) - mins
+    return np.divide(matrix - mins, span, out=np.zeros(matrix.shape), where=span != 0)
+
+def mean_columns(matrix):
+    """Mean of every column of a (dicts x features) matrix"""
+    return matrix.mean(axis=0)
+
+def group_means(matrix, groups):
+    """
+    Mean rows of a (dicts x features) matrix per group (e.g. per language
+    family). Returns the sorted group labels and a (groups x features) matrix.
+    """
+    labels, inverse = np.unique(groups, return_inverse=True)
+    membership = (inverse == np.arange(len(labels))[:, None]).astype(float) # groups x dicts
+    return labels, (membership @ matrix) / membership.sum(axis=1, keepdims=True)
+
 def normalize_dicts(dicts):
     """
     Normalize keys and values across a list of dictionaries (offset and scale).
     """
-    keys = keyset(dicts, typed=True) # list of keys and types
-    dicts = [normalize_keys(d, keys) for d in dicts] # make sure we have the same keys
-    for k,t in keys: # k: key, t: type
-        if str(t) == "<class 'dict'>":
-            values = [d[k] for d in dicts]
-            values = normalize_dicts(values)
-        else:
-            values = np.array([d[k] for d in dicts])
-            if values.max() - values.min() != 0: # avoid dividing by zero
-                values = (values - values.min()) / (values.max() - values.min())
-            else:
-                values = np.zeros(values.shape)
-        for d,v in zip(dicts, values): # d: dict, v: value
-            d[k] = v
+    dicts = normalize_structure(dicts) # make sure we have the same keys
+    schema = FeatureSchema.from_dicts(dicts, exclude=())
+    for d, row in zip(dicts, minmax_columns(schema.matrix(dicts))):
+        set_values(d, schema.columns, row)
     return dicts
 
 def mean_dict(dicts):
@@ -69,16 +107,12 @@ def mean_dict(dicts):
     Takes a list of dicts and returns a dict with mean values
     Assuming values are int/float or dict
     """
-    keys = keyset(dicts, typed=True) # list of keys and types
-    dicts = [normalize_keys(d, keys) for d in dicts] # make sure we have the same keys
-    mean = {}
-    for k,t in keys:
-        values = [d[k] for d in dicts]
-        if str(t) == "<class 'dict'>":
-            mean[k] = mean_dict(values)
-        else:
-            mean[k] = np.mean(values)
-    return mean
+    if not dicts:
+        return {}
+    dicts = normalize_structure(dicts) # make sure we have the same keys
+    schema = FeatureSchema.from_dicts(dicts, exclude=())
+    mean = copy.deepcopy(dicts[0])
+    return set_values(mean, schema.columns, mean_columns(schema.matrix(dicts)))
 
 def merge_into(dict_into, dict_from):
     # Original: https://gist.github.com/angstwad/bf22d1822c38a92ec0a9
@@ -107,24 +141,120 @@ def merge_dicts(dicts):
         merge_into(merged, d)
     return merged
 
+# Leaf keys left out of the vectors
+EXCLUDED = ['kurtosis', 'weight', 'skew', 'median', 'std', 'mean', 'depth', 'range', 'freq']
+
+def leaves(dictionary, exclude=(), prefix=()):
+    """
+    Yields (path, value) for the leaves of a dictionary with nested
+    dictionaries, path being the tuple of keys leading to the value.
+    Leaves whose key is in exclude are skipped.
+    """
+    for k, v in dictionary.items():
+        if isinstance(v, dict):
+            yield from leaves(v, exclude, prefix + (k,))
+        elif k not in exclude:
+            yield prefix + (k,), v
+
+class FeatureSchema:
+    """
+    Ordered list of feature paths (tuples of nested keys), built once from
+    a collection of dicts, that maps every dict to a vector with the same
+    columns. Paths missing from a dict get a 0 value.
+    """
+
+    def __init__(self, columns=()):
+        self.columns = list(columns)
+        self.index = {c: i for i, c in enumerate(self.columns)}
+
+    @classmethod
+    def from_dicts(cls, dicts, exclude=EXCLUDED):
+        """Schema with all the (sorted) leaf paths found in dicts"""
+        schema = cls()
+        schema.extend(dicts, exclude)
+        return schema
+
+    def extend(self, dicts, exclude=EXCLUDED):
+        """
+        Appends the (sorted) leaf paths of dicts that are not in the
+        schema yet, after the existing columns. Returns their number.
+        """
+        new = set()
+        for d in dicts:
+            new.update(path for path, _ in leaves(d, exclude) if path not in self.index)
+        for path in sorted(new):
+            self.index[path] = len(self.columns)
+            self.columns.append(path)
+        return len(new)
+
+    def __len__(self):
+        return len(self.columns)
+
+    @property
+    def names(self):
+        """Column names as strings, e.g. 'rels/obj/pospairs/VERB>NOUN'"""
+        return ['/'.join(k if isinstance(k, str) else '>'.join(map(str, k)) for k in path)
+                for path in self.columns]
+
+    def vector(self, dictionary, out=None):
+        """
+        Maps a dict to a vector (or fills out, e.g. a row of a matrix).
+        Leaves that are not in the schema are ignored.
+        """
+        if out is None:
+            out = np.zeros(len(self))
+        index = self.index
+        for path, value in leaves(dictionary):
+            i = index.get(path)
+            if i is not None:
+                out[i] = value
+        return out
+
+    def matrix(self, dicts):
+        """Maps a list of dicts to a (dicts x features) matrix"""
+        matrix = np.zeros((len(dicts), len(self)))
+        for d, row in zip(dicts, matrix):
+            self.vector(d, row)
+        return matrix
+
+    def sparse(self, dicts):
+        """
+        Maps a list of dicts to a sparse (dicts x features) CSR matrix,
+        storing only non-zero values.
+        """
+        indptr, indices, data = [0], [], []
+        index = self.index
+        for d in dicts:
+            row = sorted((index[path], value) for path, value in leaves(d)
+                         if value and path in index)
+            indices.extend(i for i, _ in row)
+            data.extend(v for _, v in row)
+            indptr.append(len(indices))
+        return scipy.sparse.csr_matrix((np.array(data, dtype=float), np.array(indices, dtype=np.int64), indptr),
+                                       shape=(len(dicts), len(self)))
+
+    def save(self, path_to_file):
+        """Saves the columns as JSON (tuple keys become lists)"""
+        with open(path_to_file, 'w', encoding='utf8') as f:
+            json.dump([[list(k) if isinstance(k, tuple) else k for k in path] for path in self.columns], f)
+
+    @classmethod
+    def load(cls, path_to_file):
+        with open(path_to_file, encoding='utf8') as f:
+            columns = json.load(f)
+        return cls(tuple(tuple(k) if isinstance(k, list) else k for k in path) for path in columns)
+
 def to_vector(dictionary):
     """Orders and flattens a dictionary (and embedded dictionaries) to a vector"""
-    ordered = OrderedDict(sorted(dictionary.items()))
-    vector = np.array([])
-    for k, v in ordered.items():
-        if isinstance(v, dict):
-            # np.append() doesn't work like list.append()
-            # if the element to append is a list, it is
-            # concatenated element-wise
-            vector = np.append(vector, to_vector(v))
-        else:
-            if k not in ['kurtosis', 'weight', 'skew', 'median', 'std', 'mean', 'depth', 'range', 'freq']:
-                vector = np.append(vector, v)
-    return vector
+    return FeatureSchema.from_dicts([dictionary]).vector(dictionary)
 
 def to_vectors(dicts):
-    """Returns a list of vectors for a list of dictionaries"""
-    return [to_vector(d) for d in dicts]
+    """Returns a list of vectors (with the same features) for a list of dictionaries"""
+    return list(FeatureSchema.from_dicts(dicts).matrix(dicts))
+
+def to_minmax_vectors(dicts):
+    """Same as to_vectors, every feature being min-max scaled across dictionaries"""
+    return list(minmax_columns(FeatureSchema.from_dicts(dicts).matrix(dicts)))
 
 def count_values(dct):
     """Recursively count the number of values in a dict with nested dicts"""
@@ -208,8 +338,20 @@ def test_merge_dicts():
 def test_to_vector():
     assert (to_vector(dummies()[4]) == np.array([1., 1., 4., 4., 4., 0.])).all()
 
+def test_group_means():
+    matrix = np.array([[1., 2.], [3., 4.], [5., 6.]])
+    labels, means = group_means(matrix, ['IE', 'Uralic', 'IE'])
+    assert list(labels) == ['IE', 'Uralic']
+    assert (means == np.array([[3., 4.], [3., 4.]])).all()
+
 def test_to_vectors():
     vectors = to_vectors(dummies())
+    assert (vectors[0] == np.array([0, 0, 0, 0, 0, 0, 0])).all()
+    assert (vectors[2] == np.array([5, 0, 0, 2, 0, 0, 0])).all()
+    assert (vectors[4] == np.array([1, 1, 4, 0, 4, 4, 0])).all()
+
+def test_to_minmax_vectors():
+    vectors = to_minmax_vectors(dummies())
     assert (vectors[0] == np.array([0/5, 0, 0, 0, 0, 0, 0])).all()
     assert (vectors[1] == np.array([1/5, 2/3, 0, 0, 0, 0, 0])).all()
     assert (vectors[2] == np.array([5/5, 0, 0, 0.5, 0, 0, 0])).all()
@@ -233,7 +375,9 @@ def test():
     test_merge_into()
     test_merge_dicts()
     test_to_vector()
+    test_group_means()
     test_to_vectors()
+    test_to_minmax_vectors()
     test_count_values()
 
 if __name__ == "__main__":
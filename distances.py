@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ---- System libraries --------------------------------------------------------
+import os
+import hashlib
+import argparse
+
+# ---- Third-party libraries ---------------------------------------------------
+import numpy as np
+from scipy.spatial.distance import pdist
+
+# ---- Project libraries -------------------------------------------------------
+from vectorize import load_matrix
+
+
+# Metrics computed by blocks of matrix products, others are left to pdist
+BLAS_METRICS = ['euclidean', 'sqeuclidean', 'cosine']
+
+
+def store_version(name):
+    """
+    Version of a matrix saved by vectorize.save_matrix:
+    a hash of its values and of its index (labels and columns).
+    """
+    digest = hashlib.sha256()
+    for fn in [name + '.json', name + '.f32']:
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def pairwise_distances(matrix, metric='euclidean', block=512):
+    """
+    Condensed distance matrix (as scipy's pdist) between the rows of
+    matrix. Euclidean and cosine distances are computed block by block
+    with matrix products, i.e. with BLAS.
+    """
+    if metric not in BLAS_METRICS:
+        return pdist(np.asarray(matrix, dtype=np.float64), metric)
+    X = np.asarray(matrix, dtype=np.float64)
+    n = len(X)
+    if metric == 'cosine':
+        norms = np.linalg.norm(X, axis=1, keepdims=True)
+        X = np.divide(X, norms, out=np.zeros_like(X), where=norms != 0)
+    sq = (X * X).sum(axis=1)
+    condensed = np.empty(n * (n - 1) // 2)
+    i_upper, j_upper = np.triu_indices(n, 1)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        gram = X[start:stop] @ X.T
+        if metric == 'cosine':
+            dist = 1 - gram
+        else:
+            dist = np.maximum(sq[start:stop, None] + sq[None, :] - 2 * gram, 0)
+            if metric == 'euclidean':
+                dist = np.sqrt(dist)
+        # Upper-triangle cells whose row is in this block
+        cells = slice(*np.searchsorted(i_upper, [start, stop]))
+        condensed[cells] = dist[i_upper[cells] - start, j_upper[cells]]
+    return condensed
+
+
+def distance_file(name, metric='euclidean', cache_dir=None, columns=None):
+    """
+    Path of the condensed distances between the rows of the matrix saved
+    as name (see vectorize.save_matrix), restricted to some columns if
+    given. They are computed once per version of the matrix, metric and
+    set of columns, and cached next to the matrix (or in cache_dir) as
+    <name>.<metric>.<version>.dist.npy.
+    """
+    version = store_version(name)[:16]
+    if columns is not None:
+        columns = np.asarray(columns, dtype=np.int64)
+        version += '-' + hashlib.sha256(columns.tobytes()).hexdigest()[:8]
+    directory = cache_dir or os.path.dirname(name) or '.'
+    fn = os.path.join(directory, '{}.{}.{}.dist.npy'.format(os.path.basename(name), metric, version))
+    if not os.path.exists(fn):
+        matrix, _, _ = load_matrix(name)
+        if columns is not None:
+            matrix = matrix[:, columns]
+        np.save(fn + '.tmp.npy', pairwise_distances(matrix, metric))
+        os.replace(fn + '.tmp.npy', fn)
+    return fn
+
+
+def distance_matrix(name, metric='euclidean', cache_dir=None, columns=None):
+    """
+    Condensed distances between the rows of the matrix saved as name
+    (see distance_file), memory-mapped from the cache.
+    """
+    return np.load(distance_file(name, metric, cache_dir, columns), mmap_mode='r')
+
+
+def subset(condensed, rows):
+    """
+    Condensed distances between a subset of rows (given by their indices,
+    in the order wanted), taken from the condensed distances of all rows.
+    """
+    n = int(round((1 + np.sqrt(1 + 8 * len(condensed))) / 2))
+    rows = np.asarray(rows)
+    a, b = np.triu_indices(len(rows), 1)
+    i, j = np.minimum(rows[a], rows[b]), np.maximum(rows[a], rows[b])
+    return np.asarray(condensed)[n * i - i * (i + 1) // 2 + j - i - 1]
+
+
+# TEST ROUTINES
+# ===================================================================
+
+def test_pairwise_distances():
+    rng = np.random.default_rng(0)
+    X = rng.random((50, 7)).astype(np.float32)
+    for metric in BLAS_METRICS:
+        assert np.allclose(pairwise_distances(X, metric, block=16), pdist(X.astype(np.float64), metric))
+
+def test_subset():
+    rng = np.random.default_rng(0)
+    X = rng.random((20, 3))
+    rows = [13, 2, 7, 19, 0]
+    assert np.allclose(subset(pdist(X), rows), pdist(X[rows]))
+
+
+def test():
+    test_pairwise_distances()
+    test_subset()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compute and cache the distances between vectors.')
+    parser.add_argument('name', nargs='?', default='data-test/vectors-all', help='matrix saved by vectorize.py (without extension)')
+    parser.add_argument('-m', '--metric', action='append', help='distance metric (can be repeated)')
+    args = parser.parse_args()
+
+    for metric in args.metric or ['euclidean']:
+        dist = distance_matrix(args.name, metric)
+        print(metric, len(dist), 'distances')
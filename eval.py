@@ -1,46 +1,167 @@
-import pickle
+import os
+import time
+import argparse
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from sklearn import metrics
 from matplotlib import pyplot as plt
-from scipy.cluster.hierarchy import dendrogram, linkage
-from sklearn.cluster import AgglomerativeClustering
+from scipy.cluster.hierarchy import dendrogram, linkage, fcluster
 from sklearn.metrics import precision_recall_fscore_support, classification_report
+from vectorize import load_matrix
+from distances import distance_file, distance_matrix, subset
 
 # UD 2.4 dataset
 gold = [6, 0, 0, 6, 0, 6, 0, 9, 4, 6, 6, 6, 10, 12, 6, 12, 12, 0, 6, 6, 6, 6, 6, 16, 16, 6, 16, 6, 6, 6, 6, 6, 0, 6, 16, 3, 6, 6, 7, 16, 15, 16, 8, 6, 6, 6, 6, 0, 6, 14, 6, 16, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 3, 5, 5, 13, 15, 6, 6, 6, 15, 2, 11, 6, 1, 1]
 families = ['Afro-Asiatic', 'Atlantic-Congo', 'Austroasiatic', 'Austronesian', 'Basque', 'Dravidian', 'IE', 'Japonic', 'Koreanic', 'Mande', 'Mongolic', 'Pama-Nyungan', 'Sino-Tibetan', 'Tai-Kadai', 'Tupian', 'Turkic', 'Uralic']
 
-data = open('data-test/vectors-all.pickle', 'rb')
-vectors = list(pickle.load(data))
-labels = [t[0] for t in vectors]
-matrix = np.asarray([t[1] for t in vectors], dtype=np.float32)
-len(matrix[0])
-
-# Clustering scikit-learn
-cluster = AgglomerativeClustering(n_clusters=17, affinity='euclidean', linkage='average')
-predicted = cluster.fit_predict(matrix)
-metrics.fowlkes_mallows_score(gold, predicted)
-
-# Clustering and Dendrogram scipy
-Z = linkage(matrix, method='ward')
-fig = plt.figure(figsize=(12, 10), dpi=300)
-dn = dendrogram(Z, labels=labels)
-fig.savefig('dend.png')
-plt.close('all')
-
-
 # Chen and Gerdes dataset
 languages = ['Ancient_Greek', 'Arabic', 'Basque', 'Bulgarian', 'Catalan', 'Chinese', 'Croatian', 'Czech', 'Danish', 'Dutch', 'English', 'Estonian', 'Finnish', 'French', 'Galician', 'German', 'Gothic', 'Greek', 'Hebrew', 'Hindi', 'Hungarian', 'Indonesian', 'Irish', 'Italian', 'Japanese', 'Korean', 'Latin', 'Latvian', 'Norwegian', 'Old_Church_Slavonic', 'Persian', 'Polish', 'Portuguese', 'Romanian', 'Russian', 'Slovak', 'Slovenian', 'Spanish', 'Swedish', 'Turkish', 'Ukrainian', 'Urdu', 'Vietnamese']
-families = ['Afro-Asiatic', 'Austroasiatic', 'Austronesian', 'Basque', 'IE', 'Japanese', 'Korean', 'Sino-Tibetan', 'Turkic', 'Uralic']
+families_sub = ['Afro-Asiatic', 'Austroasiatic', 'Austronesian', 'Basque', 'IE', 'Japanese', 'Korean', 'Sino-Tibetan', 'Turkic', 'Uralic']
 gold_sub = [4, 0, 3, 4, 4, 7, 4, 4, 4, 4, 4, 9, 9, 4, 4, 4, 4, 4, 0, 4, 9, 2, 4, 4, 5, 6, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 8, 4, 4, 1]
 pred = [1, 0, 1, 1, 1, 7, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 3, 1, 1, 2, 1, 5, 6, 1, 1, 1, 1, 4, 1, 1, 1, 1, 1, 1, 1, 1, 8, 1, 9, 1]
-metrics.fowlkes_mallows_score(gold_sub, pred)
-precision_recall_fscore_support(gold_sub, pred, average='weighted')
-print(classification_report(gold_sub, pred, target_names=families))
-# UD 2.4 subset identical to Chen and Gerdes
-matrix = np.asarray([t[1] for t in vectors if t[0] in gerdes_dataset], dtype=np.float32)
-cluster = AgglomerativeClustering(n_clusters=10, affinity='euclidean', linkage='average')
-predicted = cluster.fit_predict(matrix)
-metrics.fowlkes_mallows_score(gold_sub, predicted)
-precision_recall_fscore_support(gold_sub, predicted, average='weighted')
-print(classification_report(gold_sub, predicted, target_names=labels))
+
+# Gold sets: (languages, gold labels in the same order), None for all the languages
+GOLD_SETS = {'ud-2.4': (None, gold), 'chen-gerdes': (languages, gold_sub)}
+
+def is_pospair(column):
+    """POS pair columns: per relation (rels/<rel>/pospairs/<pair>) or coverage (pospairs/<pair>)"""
+    return column.startswith('pospairs/') or '/pospairs/' in column
+
+
+# Feature subsets, selected by column name (see dictutils.FeatureSchema.names)
+FEATURE_SUBSETS = {
+    'all': lambda column: True,
+    'branches': lambda column: '/branches/' in column,
+    'pospairs': lambda column: is_pospair(column),
+    'no-pospairs': lambda column: not is_pospair(column),
+}
+
+# Linkage methods that are only meaningful with euclidean distances
+EUCLIDEAN_METHODS = ['ward', 'centroid', 'median']
+
+
+def explore(name='data-test/vectors-all'):
+    """Evaluation of one clustering per dataset, with a dendrogram"""
+    # Memory-mapped float32 matrix (see vectorize.save_matrix)
+    matrix, labels, columns = load_matrix(name)
+
+    # Pairwise distances, computed once and cached on disk (see distances.py)
+    distances = distance_matrix(name, 'euclidean')
+
+    # Clustering (average linkage, cut into 17 clusters)
+    predicted = fcluster(linkage(distances, method='average'), 17, criterion='maxclust')
+    print(metrics.fowlkes_mallows_score(gold, predicted))
+
+    # Clustering and Dendrogram scipy
+    Z = linkage(distances, method='ward')
+    fig = plt.figure(figsize=(12, 10), dpi=300)
+    dn = dendrogram(Z, labels=labels)
+    fig.savefig('dend.png')
+    plt.close('all')
+
+    # Chen and Gerdes dataset
+    print(metrics.fowlkes_mallows_score(gold_sub, pred))
+    print(precision_recall_fscore_support(gold_sub, pred, average='weighted'))
+    print(classification_report(gold_sub, pred, target_names=families_sub))
+    # UD 2.4 subset identical to Chen and Gerdes
+    rows = [i for i, l in enumerate(labels) if l in languages]
+    predicted = fcluster(linkage(subset(distances, rows), method='average'), 10, criterion='maxclust')
+    print(metrics.fowlkes_mallows_score(gold_sub, predicted))
+    print(precision_recall_fscore_support(gold_sub, predicted, average='weighted'))
+
+
+def evaluate(dist_file, rows, gold_labels, method, ks):
+    """
+    Cluster the rows of a cached distance matrix with one linkage method
+    and score every cut (number of clusters in ks) against the gold labels.
+    Runs in a worker process. Returns (k, Fowlkes-Mallows, adjusted Rand,
+    seconds) tuples, seconds being the linkage time plus the cut time.
+    """
+    distances = np.load(dist_file, mmap_mode='r')
+    if rows is not None:
+        distances = subset(distances, rows)
+    start = time.perf_counter()
+    Z = linkage(distances, method=method)
+    linkage_time = time.perf_counter() - start
+    results = []
+    for k in ks:
+        start = time.perf_counter()
+        predicted = fcluster(Z, k, criterion='maxclust')
+        fm = metrics.fowlkes_mallows_score(gold_labels, predicted)
+        ari = metrics.adjusted_rand_score(gold_labels, predicted)
+        results.append((k, fm, ari, linkage_time + time.perf_counter() - start))
+    return results
+
+
+def sweep(name, methods, distance_metrics, ks, subsets, jobs=1):
+    """
+    Evaluate every combination of gold set x feature subset x metric x
+    linkage method x number of clusters. Distances are computed (or
+    loaded from the cache) once per feature subset and metric, and the
+    linkages are run in a process pool.
+    Returns the results as dicts, best Fowlkes-Mallows scores first
+    within each gold set.
+    """
+    _, labels, columns = load_matrix(name)
+    tasks = []
+    for subset_name in subsets:
+        if subset_name == 'all':
+            cols = None
+        elif columns is None:
+            print('  SKIPPING: no column names to select', subset_name)
+            continue
+        else:
+            cols = [i for i, c in enumerate(columns) if FEATURE_SUBSETS[subset_name](c)]
+        for metric in distance_metrics:
+            dist_file = distance_file(name, metric, columns=cols)
+            for gold_name, (gold_languages, gold_labels) in GOLD_SETS.items():
+                rows = None if gold_languages is None else [i for i, l in enumerate(labels) if l in gold_languages]
+                if len(gold_labels) != (len(labels) if rows is None else len(rows)):
+                    print('  SKIPPING: the languages do not match the gold set', gold_name)
+                    continue
+                for method in methods:
+                    if method in EUCLIDEAN_METHODS and metric != 'euclidean':
+                        continue
+                    config = {'gold': gold_name, 'features': subset_name, 'metric': metric, 'method': method}
+                    tasks.append((config, (dist_file, rows, gold_labels, method, ks)))
+
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(evaluate, *args) for _, args in tasks]
+        results = [dict(config, k=k, fowlkes_mallows=fm, adjusted_rand=ari, seconds=seconds)
+                   for (config, _), future in zip(tasks, futures)
+                   for k, fm, ari, seconds in future.result()]
+
+    results.sort(key=lambda r: (r['gold'], -r['fowlkes_mallows']))
+    for gold_name in GOLD_SETS:
+        ranked = [r for r in results if r['gold'] == gold_name]
+        for rank, r in enumerate(ranked, 1):
+            r['rank'] = rank
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Evaluate the clustering of the corpora vectors against language families.')
+    parser.add_argument('name', nargs='?', default='data-test/vectors-all', help='matrix saved by vectorize.py (without extension)')
+    parser.add_argument('--sweep', action='store_true', help='evaluate a grid of clustering configurations')
+    parser.add_argument('-m', '--methods', nargs='+', default=['single', 'complete', 'average', 'weighted', 'ward'], help='linkage methods')
+    parser.add_argument('-d', '--metrics', nargs='+', default=['euclidean', 'cosine', 'cityblock'], help='distance metrics')
+    parser.add_argument('-k', '--clusters', nargs='+', type=int, default=list(range(2, 31)), help='numbers of clusters')
+    parser.add_argument('-f', '--features', nargs='+', default=sorted(FEATURE_SUBSETS), choices=sorted(FEATURE_SUBSETS), help='feature subsets')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('-o', '--output', default='sweep.tsv', help='ranked results table')
+    args = parser.parse_args()
+
+    if not args.sweep:
+        explore(args.name)
+    else:
+        results = sweep(args.name, args.methods, args.metrics, args.clusters, args.features, args.jobs)
+        fields = ['gold', 'rank', 'fowlkes_mallows', 'adjusted_rand', 'features', 'metric', 'method', 'k', 'seconds']
+        with open(args.output, 'w', encoding='utf8') as f:
+            print('\t'.join(fields), file=f)
+            for r in results:
+                print('\t'.join(str(r[field]) for field in fields), file=f)
+        for r in results:
+            if r['rank'] <= 5:
+                print('{gold:12} {rank:2} FM={fowlkes_mallows:.3f} ARI={adjusted_rand:.3f} '
+                      '{features}/{metric}/{method} k={k} ({seconds:.4f} s)'.format(**r))
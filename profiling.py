@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ---- System libraries --------------------------------------------------------
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def max_rss_mb():
+    """
+    High-water mark of the resident set size of the current process, in
+    MB (None if unknown): the peak of everything it ran so far.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def reset_hwm():
+    """
+    Reset the high-water mark of the RSS of the process (VmHWM) to its
+    current RSS. Returns False where it can't be reset (outside of Linux).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def hwm_mb():
+    """High-water mark of the RSS since the last reset_hwm, in MB (None if unknown)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10 # kB
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# Peak measurements in progress in this process, and whether
+# the high-water mark could be reset when the first one started
+_peaks = 0
+_peaks_reset = False
+_peaks_lock = threading.Lock()
+
+
+def timed(profile, stage, language=None, **counts):
+    """profile.stage(...), or a context doing nothing without a profile"""
+    return nullcontext() if profile is None else profile.stage(stage, language, **counts)
+
+
+class Profile:
+    """
+    Opt-in instrumentation of a pipeline: wall time, CPU time, counts
+    (e.g. sentences and tokens) and peak RSS per stage and per language.
+    Entering the same stage again (e.g. once per sentence) adds to its
+    totals. A profile is picklable, so that worker processes can send
+    theirs back to be merged (extend).
+    """
+
+    def __init__(self):
+        self.records = {} # {(language, stage): record}
+        self.start = time.perf_counter()
+
+    def record(self, stage, language=None):
+        record = self.records.get((language, stage))
+        if record is None:
+            record = self.records[(language, stage)] = {'language': language, 'stage': stage, 'calls': 0,
+                                                         'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': None}
+        return record
+
+    @contextmanager
+    def peak(self, language, *stages):
+        """
+        Measure the peak RSS of the enclosed block (once, whatever it runs)
+        as the peak_rss_mb of stages. The high-water mark of the process is
+        reset when the block starts, unless another block is already being
+        measured (nested or in another thread): both then get the peak since
+        the first one started. None where it can't be reset (see reset_hwm).
+        """
+        global _peaks, _peaks_reset
+        with _peaks_lock:
+            if _peaks == 0:
+                _peaks_reset = reset_hwm()
+            reset = _peaks_reset
+            _peaks += 1
+        try:
+            yield
+        finally:
+            with _peaks_lock:
+                _peaks -= 1
+            peak = hwm_mb() if reset else None
+            if peak is not None:
+                for stage in stages:
+                    record = self.record(stage, language)
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0.0, peak)
+
+    @contextmanager
+    def stage(self, stage, language=None, memory=True, **counts):
+        """
+        Time the enclosed block as (one call of) a stage, and measure its
+        peak RSS if memory. Stages entered once per sentence should not
+        measure their memory, see peak.
+        """
+        record = self.record(stage, language)
+        with self.peak(language, stage) if memory else nullcontext():
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                yield record
+            finally:
+                record['wall'] += time.perf_counter() - wall
+                record['cpu'] += time.process_time() - cpu
+                record['calls'] += 1
+                self.count(stage, language, **counts)
+
+    def iterate(self, iterable, stage, language=None):
+        """
+        Yield the items of iterable, timing only the production of the
+        items (e.g. parsing), not what the caller does with them. The
+        memory is not measured, see peak.
+        """
+        record = self.record(stage, language)
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                record['wall'] += time.perf_counter() - wall
+                record['cpu'] += time.process_time() - cpu
+            record['calls'] += 1
+            yield item
+        self.count(stage, language)
+
+    def count(self, stage, language=None, **counts):
+        """Add counts to a stage"""
+        record = self.record(stage, language)
+        for k, v in counts.items():
+            record[k] = record.get(k, 0) + v
+
+    def add(self, other_record, language=None):
+        """Add the times and counts of a record to the same stage of language"""
+        record = self.record(other_record['stage'], language)
+        for k, v in other_record.items():
+            if k == 'peak_rss_mb':
+                record[k] = v if record[k] is None else max(record[k], v or 0)
+            elif k not in ['language', 'stage']:
+                record[k] = record.get(k, 0) + v
+
+    def extend(self, other):
+        """Add the records of another profile (e.g. from a worker process)"""
+        for record in other.records.values():
+            self.add(record, record['language'])
+        return self
+
+    def totals(self):
+        """Records summed over the languages, per stage"""
+        totals = Profile()
+        for record in self.records.values():
+            totals.add(record)
+        return list(totals.records.values())
+
+    def report(self):
+        """
+        JSON-serializable report: the records, the totals per stage and
+        the whole run (max_rss_mb being the high-water mark of this process)
+        """
+        return {
+            'command': sys.argv,
+            'pid': os.getpid(),
+            'wall': time.perf_counter() - self.start,
+            'cpu': time.process_time(),
+            'max_rss_mb': max_rss_mb(),
+            'stages': list(self.records.values()),
+            'totals': self.totals(),
+        }
+
+    def save(self, path_to_file):
+        with open(path_to_file, 'w', encoding='utf8') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+# TEST ROUTINES
+# ===================================================================
+
+def test_profile():
+    profile = Profile()
+    for lng in ['a', 'b']:
+        for x in profile.iterate(range(3), 'parse', lng):
+            with profile.stage('stats', lng, tokens=x):
+                pass
+    assert profile.records[('a', 'parse')]['calls'] == 3
+    assert profile.records[('b', 'stats')]['tokens'] == 3
+    worker = Profile()
+    with worker.stage('stats', 'a', tokens=4):
+        pass
+    profile.extend(worker)
+    assert profile.records[('a', 'stats')]['calls'] == 4
+    assert profile.records[('a', 'stats')]['tokens'] == 7
+    totals = {r['stage']: r for r in profile.totals()}
+    assert totals['stats']['calls'] == 7 and totals['stats']['tokens'] == 10
+    json.dumps(profile.report())
+    # The peak of a stage includes the memory it freed, but not the peaks of earlier stages
+    if reset_hwm():
+        with profile.stage('alloc', 'b'):
+            freed = bytearray(128 * 2**20)
+            freed[::4096] = b'x' * len(freed[::4096])
+            del freed
+        with profile.stage('after', 'b'):
+            pass
+        assert profile.records[('b', 'alloc')]['peak_rss_mb'] > profile.records[('b', 'after')]['peak_rss_mb'] + 64
+
+
+def test():
+    test_profile()
+
+if __name__ == "__main__":
+    test()
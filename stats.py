@@ -3,15 +3,28 @@
 
 # Third-party libraries
 import numpy as np
-from pprint import pprint
+from pprint import pprint, pformat
 import scipy.stats
 import os
+import json
+import math
+import hashlib
+import re
+import fnmatch
 import pickle
+from collections import Counter
 
 # Project libraries
-from conll import parse_tree_conll
+from conll import iter_trees_conll, iter_arrays_conll, Sentence
+from conll import iter_sentences_conll, sentence_offsets, shard_ranges, SentenceIndex
+from conll import is_compressed, is_conll_file, conll_stem, conll_files
 import dictutils as du
+from profiling import Profile, timed
 import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from conllu.exceptions import ParseException
 
 def tree_stats(tree, root_distance=0, gov_pos='ROOT'):
 
@@ -30,6 +43,11 @@ def tree_stats(tree, root_distance=0, gov_pos='ROOT'):
     stats['weight'] = sum([c['weight'] for c in children_stats]) + 1
     stats['depth'] = max([c['depth'] for c in children_stats], default=-1) + 1
 
+    # Branch length (depth) and thickness (weight) of the subtree
+    for key, label in [('rels', rel), ('postags', pos)]:
+        stats[key][label]['length'] = [stats['depth']]
+        stats[key][label]['thickness'] = [stats['weight']]
+
     # Dependency distance and hierarchical distance
     if tree.token['head'] == 0: # Tree is the sentence's root
         stats['dd'] = 0
@@ -63,6 +81,123 @@ def tree_stats(tree, root_distance=0, gov_pos='ROOT'):
     return stats
 
 
+def label_stats(codes, labels, values, left, right, stats, pairs=None):
+    """
+    Group the branching counts of the words of a sentence by label
+    (relation or POS tag) and add them to stats, as in tree_stats.
+    values maps the keys of the lists of values per word ('branches',
+    'length', 'thickness') to arrays with one value per word.
+    Codes whose labels only differ by their subtype are merged.
+    pairs, if given, is (postags, codes): the code of the (governor,
+    dependent) POS pair of each word is gov * len(postags) + dep.
+    """
+    uniq, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    grouped = {k: v[order].tolist() for k, v in values.items()} # grouped by label
+    bounds = np.cumsum(counts).tolist()
+    starts = [0] + bounds[:-1]
+    lefts = np.bincount(inverse, weights=left).astype(int).tolist()
+    rights = np.bincount(inverse, weights=right).astype(int).tolist()
+    if pairs is not None:
+        postags, codes = pairs
+        npairs = len(postags) ** 2
+        keys, pair_counts = np.unique(inverse * npairs + codes, return_counts=True)
+    for k, code in enumerate(uniq.tolist()):
+        label = labels[code].split(':')[0] # ignoring subtypes
+        entry = stats.get(label)
+        if entry is None:
+            entry = stats[label] = {'count': 0, 'right': 0, 'left': 0, **{key: [] for key in grouped}}
+        for key, v in grouped.items():
+            entry[key] += v[starts[k]:bounds[k]]
+        entry['count'] += bounds[k] - starts[k]
+        entry['right'] += rights[k]
+        entry['left'] += lefts[k]
+    if pairs is not None:
+        for key, count in zip(keys.tolist(), pair_counts.tolist()):
+            k, p = divmod(key, npairs)
+            pair = (postags[p // len(postags)], postags[p % len(postags)])
+            pospairs = stats[labels[uniq[k]].split(':')[0]].setdefault('pospairs', {})
+            pospairs[pair] = pospairs.get(pair, 0) + count
+
+
+def sentence_stats(sentence):
+    """
+    Same statistics as tree_stats, computed from the head array of a
+    conll.Sentence (fast parser) with NumPy operations instead of a
+    recursive traversal. Values per relation and POS tag are summed;
+    branches are listed in linear order instead of tree order.
+    """
+    ids = sentence.ids.astype(np.intp)
+    heads = sentence.heads.astype(np.intp)
+    n = len(ids)
+    if n == 0:
+        raise ValueError('empty sentence')
+    if not np.array_equal(ids, np.arange(1, n+1)):
+        raise ValueError('non-consecutive word IDs in sentence')
+    if heads.min() < 0 or heads.max() > n:
+        raise ValueError('head out of range in sentence')
+
+    # Number of dependents of each node (index 0 is the virtual root)
+    nchildren = np.bincount(heads, minlength=n+1)
+    if nchildren[0] != 1:
+        raise ValueError('sentence should have exactly one root')
+    nchildren = nchildren[1:]
+    right = np.bincount(heads[ids > heads], minlength=n+1)[1:] # dependents after their head
+    left = np.bincount(heads[ids < heads], minlength=n+1)[1:] # dependents before their head
+
+    # Distance to the virtual root by pointer jumping: anc[i] is the
+    # 2^k-th ancestor of node i after k steps, dist[i] the distance to it
+    anc = np.concatenate(([0], heads))
+    dist = np.ones(n+1, dtype=np.intp)
+    dist[0] = 0
+    for _ in range(n.bit_length() + 1):
+        if not anc.any():
+            break
+        dist, anc = dist + dist[anc], anc[anc]
+    else:
+        raise ValueError('sentence is not a tree')
+    hd = dist[1:] - 1 # hierarchical distance (the root is at 0)
+    dd = np.where(heads > 0, np.abs(heads - ids) - 1, 0) # dependency distance
+
+    # Subtree weight (branch thickness) and depth (branch length) of each
+    # node, passed up to the heads from the deepest nodes to the root
+    thickness = [1] * (n+1)
+    length = [0] * (n+1)
+    head_list = heads.tolist()
+    for i in np.argsort(hd, kind='stable')[::-1].tolist():
+        node, head = i + 1, head_list[i]
+        thickness[head] += thickness[node]
+        length[head] = max(length[head], length[node] + 1)
+    values = {'branches': nchildren, 'length': np.array(length[1:]), 'thickness': np.array(thickness[1:])}
+
+    stats = {}
+    stats['root_id'] = int(np.flatnonzero(heads == 0)[0]) + 1
+    stats['weight'] = n
+    stats['depth'] = int(hd.max())
+    stats['dd'] = 0
+    stats['hd'] = 0
+    stats['ddsum'] = int(dd.sum())
+    stats['hdsum'] = int(hd.sum())
+    stats['mdd'] = stats['ddsum'] / (n - 1) if n > 1 else 0
+    stats['mhd'] = stats['hdsum'] / (n - 1) if n > 1 else 0
+
+    # Branching and count stats for relations and POS tags
+    upos = sentence.upos.astype(np.intp)
+    postags = list(sentence.upos_labels) + ['ROOT']
+    gov = np.concatenate(([len(postags) - 1], upos))[heads] # 0 is ROOT
+    pairs = (postags, gov * len(postags) + upos)
+    stats['rels'] = {}
+    stats['postags'] = {}
+    label_stats(sentence.deprels, sentence.deprel_labels, values, left, right, stats['rels'], pairs)
+    label_stats(sentence.upos, sentence.upos_labels, values, left, right, stats['postags'])
+    return stats
+
+
+def any_tree_stats(tree):
+    """tree_stats of a TokenTree, or sentence_stats of a conll.Sentence"""
+    return sentence_stats(tree) if isinstance(tree, Sentence) else tree_stats(tree)
+
+
 def describe_dist(dist):
     # Sanity check
     try:
@@ -71,6 +206,7 @@ def describe_dist(dist):
     except:
         raise ValueError('cannot decribe as a curve {}'.format(dist))
 
+    dist = np.sort(dist) # results do not depend on the order of values
     d = {}
     d['mean'] = np.mean(dist) # location
     d['median'] = np.median(dist) # location
@@ -83,53 +219,386 @@ def describe_dist(dist):
     return d
 
 
+def hist_quantile(values, cumcounts, q):
+    """
+    Quantile q of the data described by sorted distinct values and their
+    cumulative counts, with linear interpolation (as np.percentile).
+    """
+    pos = q * (cumcounts[-1] - 1)
+    lo = math.floor(pos)
+    x_lo = values[np.searchsorted(cumcounts, lo, side='right')]
+    x_hi = values[np.searchsorted(cumcounts, math.ceil(pos), side='right')]
+    return x_lo + (pos - lo) * (x_hi - x_lo)
+
+
+def describe_hist(hist):
+    """
+    Same as describe_dist, computed from a histogram {value: count}
+    (weighted moments and cumulative counts) instead of a list of values,
+    i.e. in O(number of distinct values).
+    """
+    # Sanity check
+    try:
+        assert len(hist) > 0
+        assert min([isinstance(v, (int, float)) and isinstance(n, int) and n > 0 for v, n in hist.items()]) == True
+    except AssertionError:
+        raise ValueError('cannot decribe as a curve {}'.format(hist))
+
+    values, counts = zip(*sorted(hist.items()))
+    values = np.array(values, dtype=float)
+    counts = np.array(counts, dtype=float)
+    cumcounts = np.cumsum(counts)
+    n = cumcounts[-1]
+
+    # Central moments (biased, as np.std and scipy.stats)
+    mean = np.dot(counts, values) / n
+    dev = values - mean
+    m2 = np.dot(counts, dev ** 2) / n
+    m3 = np.dot(counts, dev ** 3) / n
+    m4 = np.dot(counts, dev ** 4) / n
+
+    d = {}
+    d['mean'] = mean # location
+    d['median'] = hist_quantile(values, cumcounts, 0.5) # location
+    d['std'] = np.sqrt(m2) # spread
+    d['range'] = hist_quantile(values, cumcounts, 0.75) - hist_quantile(values, cumcounts, 0.25) # spread
+    d['skew'] = m3 / m2 ** 1.5 if m2 > 0 else np.nan # shape (undefined for constant data)
+    d['kurtosis'] = m4 / m2 ** 2 - 3 if m2 > 0 else np.nan # shape (Fisher's definition)
+    return d
+
+
+def add_partial(partials, x):
+    """
+    Add x to a list of non-overlapping partial sums (Shewchuk's algorithm,
+    as in math.fsum), so that math.fsum(partials) is the exact sum
+    whatever the order in which values were added or lists were merged.
+    """
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+class CorpusAccumulator:
+    """
+    Running totals for corpus statistics. Trees are added one at a time
+    (add_tree), partial accumulators from other shards or processes can be
+    combined (merge) and the corpus stats are derived at the end (finalize).
+    Branch counts are kept as histograms {value: count}, so memory only
+    depends on the number of distinct labels, not on the corpus size.
+    """
+
+    def __init__(self):
+        self.size = 0 # number of sentences
+        self.weight = 0 # number of words
+        self.depth = 0
+        self.ddsum = 0
+        self.hdsum = 0
+        self.mdd = [] # partial sums of sentence MDDs (see add_partial)
+        self.mhd = [] # partial sums of sentence MHDs
+        self.rels = {}
+        self.postags = {}
+        self.pospairs = Counter() # number of sentences containing each POS pair
+
+    @staticmethod
+    def new_entry(key):
+        entry = {'count': 0, 'sentences': 0, 'left': 0, 'right': 0,
+                 'branches': Counter(), 'length': Counter(), 'thickness': Counter()}
+        if key == 'rels':
+            entry['pospairs'] = Counter()
+        return entry
+
+    def add_tree(self, tree):
+        """
+        Add a sentence, either a TokenTree (conll.iter_trees_conll)
+        or a Sentence (conll.iter_arrays_conll).
+        """
+        self.add_stats(any_tree_stats(tree))
+
+    def add_stats(self, stats):
+        """Add the statistics of one sentence (from tree_stats or sentence_stats)"""
+        self.size += 1
+        self.weight += stats['weight']
+        self.depth += stats['depth']
+        self.ddsum += stats['ddsum']
+        self.hdsum += stats['hdsum']
+        add_partial(self.mdd, stats['mdd'])
+        add_partial(self.mhd, stats['mhd'])
+        for key in ['rels', 'postags']:
+            totals = getattr(self, key)
+            for label, dic in stats[key].items():
+                entry = totals.get(label)
+                if entry is None:
+                    entry = totals[label] = self.new_entry(key)
+                entry['count'] += dic['count']
+                entry['sentences'] += 1 # sentences containing the label
+                entry['left'] += dic['left']
+                entry['right'] += dic['right']
+                entry['branches'].update(dic['branches']) # list of values
+                entry['length'].update(dic['length'])
+                entry['thickness'].update(dic['thickness'])
+                if key == 'rels':
+                    entry['pospairs'].update(dic['pospairs']) # dict of counts
+        self.pospairs.update({pair for dic in stats['rels'].values() for pair in dic['pospairs']})
+
+    def merge(self, other):
+        """Add the totals of another accumulator to this one"""
+        self.size += other.size
+        self.weight += other.weight
+        self.depth += other.depth
+        self.ddsum += other.ddsum
+        self.hdsum += other.hdsum
+        for x in other.mdd:
+            add_partial(self.mdd, x)
+        for x in other.mhd:
+            add_partial(self.mhd, x)
+        self.pospairs.update(other.pospairs)
+        for key in ['rels', 'postags']:
+            totals = getattr(self, key)
+            for label, dic in getattr(other, key).items():
+                entry = totals.get(label)
+                if entry is None:
+                    entry = totals[label] = self.new_entry(key)
+                for k, v in dic.items():
+                    entry[k] += v # numbers and Counters
+        return self
+
+    def state(self):
+        """The totals as plain data (numbers, lists, dicts and Counters), see from_state"""
+        return dict(vars(self))
+
+    @classmethod
+    def from_state(cls, state):
+        """Accumulator holding the totals returned by state"""
+        accumulator = cls()
+        vars(accumulator).update(state)
+        return accumulator
+
+    def finalize(self):
+        """Return the corpus statistics (as corpus_stats)"""
+        if self.size == 0:
+            raise ValueError('empty corpus')
+
+        # Initialize dictionary
+        corpus = {}
+        corpus['rels'] = {rel: {'pospairs': dict()} for rel in self.rels.keys()}
+        corpus['postags'] = {pos: dict() for pos in self.postags.keys()}
+
+        # Corpus stats (means)
+        corpus['mdd'] = math.fsum(self.mdd) / self.size # MDD
+        corpus['mhd'] = math.fsum(self.mhd) / self.size # MHD
+        corpus['depth'] = self.depth / self.size # mean depth
+        corpus['weight'] = self.weight / self.size # mean weight
+
+        # Processing rels and postags the same way (except pos pairs)
+        for key in ['rels', 'postags']:
+            for pos_rel, dic in getattr(self, key).items():
+                # pos_rel is the key for (a relation or a postag)
+                # dic is the value (dict with branching and count information)
+
+                # Relative frequency and coverage (share of the sentences containing it)
+                corpus[key][pos_rel]['freq'] = dic['count'] / self.weight
+                corpus[key][pos_rel]['coverage'] = dic['sentences'] / self.size
+
+                # Sanity check
+                sum_branches = sum(v * n for v, n in dic['branches'].items())
+                try:
+                    assert dic['left'] + dic['right'] == sum_branches
+                    assert sum(dic['branches'].values()) == dic['count']
+                except AssertionError:
+                    raise ValueError('Inconsistent values for {}'.format(pos_rel))
+
+                # Branching
+                corpus[key][pos_rel]['branches'] = {}
+                corpus[key][pos_rel]['branches']['dist'] = describe_hist(dic['branches'])
+                corpus[key][pos_rel]['branches']['left'] = dic['left'] / sum_branches if sum_branches > 0 else 0
+                corpus[key][pos_rel]['branches']['right'] = dic['right'] / sum_branches if sum_branches > 0 else 0
+
+                # Branch length and thickness
+                corpus[key][pos_rel]['length'] = describe_hist(dic['length'])
+                corpus[key][pos_rel]['thickness'] = describe_hist(dic['thickness'])
+
+                # Pos pairs (only for relations)
+                if key == 'rels':
+                    sum_pairs = sum(dic['pospairs'].values())
+                    for pair, val in dic['pospairs'].items():
+                        corpus[key][pos_rel]['pospairs'][pair] = val / sum_pairs
+
+        # Coverage of the POS pairs (whatever the relation)
+        corpus['pospairs'] = {pair: n / self.size for pair, n in self.pospairs.items()}
+
+        return corpus
+
+
+class SentenceRecorder:
+    """
+    Per-sentence values that corpus_stats averages away (weight, depth,
+    MDD, MHD, DD and HD sums), kept as typed columns. Sentences are
+    numbered in file order from first (see conll.SentenceIndex), so
+    that recorders of consecutive shards can be concatenated (merge).
+    """
+
+    COLUMNS = {'weight': np.int32, 'depth': np.int32, 'ddsum': np.int64, 'hdsum': np.int64,
+               'mdd': np.float64, 'mhd': np.float64}
+
+    def __init__(self, first=0):
+        self.first = first
+        self.values = {k: [] for k in self.COLUMNS}
+
+    def __len__(self):
+        return len(self.values['weight'])
+
+    def add_stats(self, stats):
+        """Add the statistics of one sentence (from tree_stats or sentence_stats)"""
+        for k, values in self.values.items():
+            values.append(stats[k])
+
+    def merge(self, other):
+        """Append the sentences of the shard following this one"""
+        for k, values in self.values.items():
+            values.extend(other.values[k])
+        return self
+
+    def columns(self):
+        """{'id': sentence numbers, metric: values} as NumPy arrays"""
+        columns = {'id': np.arange(self.first, self.first + len(self), dtype=np.int64)}
+        for k, dtype in self.COLUMNS.items():
+            columns[k] = np.array(self.values[k], dtype=dtype)
+        return columns
+
+    def save(self, path_to_file):
+        """Save the columns as a .npz archive (see load_sentences)"""
+        np.savez(path_to_file, **self.columns())
+
+    @classmethod
+    def load(cls, path_to_file):
+        """Recorder holding the sentences saved in a .npz archive, to add more"""
+        columns = load_sentences(path_to_file)
+        recorder = cls(int(columns['id'][0]) if len(columns['id']) else 0)
+        for k, values in recorder.values.items():
+            values.extend(columns[k].tolist())
+        return recorder
+
+
+def load_sentences(path_to_file):
+    """Load per-sentence columns saved by SentenceRecorder.save as {name: array}"""
+    with np.load(path_to_file) as columns:
+        return dict(columns)
+
+
+def accumulate(trees, profile=None, language=None, recorder=None, accumulator=None):
+    """
+    Accumulate the statistics of trees (in a new accumulator, or the one
+    given), and pass the statistics of each sentence to recorder (if any).
+    With a profile (see profiling.py), the parsing (producing the trees)
+    and the stats are timed separately (their peak RSS is the same).
+    """
+    accumulator = CorpusAccumulator() if accumulator is None else accumulator
+    if recorder is None:
+        add = accumulator.add_tree
+    else:
+        def add(tree):
+            stats = any_tree_stats(tree)
+            accumulator.add_stats(stats)
+            recorder.add_stats(stats)
+    size, weight = accumulator.size, accumulator.weight
+    if profile is None:
+        for tree in trees:
+            add(tree)
+    else:
+        # Timed per sentence, the memory is measured once over all the sentences
+        with profile.peak(language, 'parse', 'stats'):
+            for tree in profile.iterate(trees, 'parse', language):
+                with profile.stage('stats', language, memory=False):
+                    add(tree)
+        profile.count('parse', language, sentences=accumulator.size - size, tokens=accumulator.weight - weight)
+    return accumulator
+
+
 def corpus_stats(trees):
 
-    size = len(trees)
-    merged = du.merge_dicts([tree_stats(tree) for tree in trees]) # values are summed
+    # Trees are consumed one at a time, so that any iterable
+    # (e.g. conll.iter_trees_conll) can be processed in constant memory
+    return accumulate(trees).finalize()
 
-    # Initialize dictionary
-    corpus = {}
-    corpus['rels'] = {rel: {'pospairs': dict()} for rel in merged['rels'].keys()}
-    corpus['postags'] = {pos: dict() for pos in merged['postags'].keys()}
 
-    # Corpus stats (means)
-    corpus['mdd'] = merged['mdd'] / size # MDD
-    corpus['mhd'] = merged['mhd'] / size # MHD
-    corpus['depth'] = merged['depth'] / size # mean depth
-    corpus['weight'] = merged['weight'] / size # mean weight
+def shard_stats(path_to_file, parser='conllu', start=0, end=None, profile=None, language=None, recorder=None):
+    """
+    Accumulate the statistics of the sentences in a byte range
+    of a corpus (see conll.shard_ranges). Runs in a worker process.
+    Returns (accumulator, recorder, profile), recorder and profile being
+    the ones given (if any) with the sentences and timings of the shard.
+    """
+    trees = PARSERS[parser](path_to_file, start=start, end=end)
+    accumulator = accumulate(trees, profile, language, recorder)
+    return accumulator, recorder, profile
 
-    # Processing merged['rels'] and merged['postags'] the same way (except pos pairs)
-    for key in ['rels', 'postags']:
-        for pos_rel, dic in merged[key].items():
-            # print(key, pos_rel)
-            # pos_rel is the key for (a relation or a postag)
-            # dic is the value (dict with branching and count information)
 
-            # Relative frequency
-            corpus[key][pos_rel]['freq'] = dic['count'] / merged['weight']
+def accumulate_files(paths, parser='conllu', shards=1, pool=None, profile=None, language=None, record=False):
+    """
+    Accumulate the statistics of several files (e.g. the treebanks of a
+    language), each one split into byte-range shards if shards > 1
+    (compressed files cannot be split, they are read as a whole).
+    The shards of all the files are computed in parallel (if a process
+    pool is given) and merged per file. The timings of the shards are
+    added to profile (if any).
+    Returns one (accumulator, recorder) per file, recorder holding the
+    values of its sentences if record (None otherwise).
+    """
+    tasks = []
+    for i, path in enumerate(paths):
+        if shards > 1 and not is_compressed(path):
+            offsets = sentence_offsets(path)
+            tasks += [(i, path, start, end, int(np.searchsorted(offsets, start)))
+                      for start, end in shard_ranges(offsets, shards)]
+        else:
+            tasks.append((i, path, 0, None, 0))
+    run = pool.map if pool else map
+    results = run(shard_stats, [path for _, path, _, _, _ in tasks], itertools.repeat(parser),
+                  [start for _, _, start, _, _ in tasks], [end for _, _, _, end, _ in tasks],
+                  [None if profile is None else Profile() for _ in tasks], itertools.repeat(language),
+                  [SentenceRecorder(first) if record else None for _, _, _, _, first in tasks])
+    files = [(CorpusAccumulator(), SentenceRecorder() if record else None) for _ in paths]
+    for (i, _, _, _, _), (partial, shard_recorder, shard_profile) in zip(tasks, results):
+        accumulator, recorder = files[i]
+        with timed(profile, 'merge', language):
+            accumulator.merge(partial)
+            if record:
+                recorder.merge(shard_recorder)
+        if profile is not None:
+            profile.extend(shard_profile)
+    return files
 
-            # Sanity check
-            try:
-                assert dic['left'] + dic['right'] == sum(dic['branches'])
-                assert len(dic['branches']) == dic['count' ]
-            except:
-                raise ValueError('Inconsistent values for {}'.format(pos_rel))
 
-            # Branching
-            corpus[key][pos_rel]['branches'] = {}
-            sum_branches = sum(dic['branches'])
-            corpus[key][pos_rel]['branches']['dist'] = describe_dist(dic['branches'])
-            corpus[key][pos_rel]['branches']['left'] = dic['left'] / sum_branches if sum_branches > 0 else 0
-            corpus[key][pos_rel]['branches']['right'] = dic['right'] / sum_branches if sum_branches > 0 else 0
+def sharded_accumulate(path_to_file, parser='conllu', shards=2, pool=None, profile=None, language=None,
+                       recorder=None):
+    """
+    Accumulate the statistics of a whole file, split into byte-range
+    shards whose partial statistics are computed in parallel (if a
+    process pool is given) and then merged.
+    The timings of the shards are added to profile and their
+    sentences to recorder (if any).
+    """
+    [(accumulator, shard_recorder)] = accumulate_files([path_to_file], parser, shards, pool, profile, language,
+                                                       recorder is not None)
+    if recorder is not None:
+        recorder.merge(shard_recorder)
+    return accumulator
 
-            # Pos pairs (only for relations)
-            if key == 'rels':
-                sum_pairs = sum(dic['pospairs'].values())
-                for pair, val in dic['pospairs'].items():
-                    corpus[key][pos_rel]['pospairs'][pair] = val / sum_pairs
 
-    return corpus
+def sharded_corpus_stats(path_to_file, parser='conllu', shards=2, pool=None, profile=None, language=None,
+                         recorder=None):
+    """Same as corpus_stats on a whole file, computed by shards (see sharded_accumulate)"""
+    accumulator = sharded_accumulate(path_to_file, parser, shards, pool, profile, language, recorder)
+    with timed(profile, 'finalize', language):
+        return accumulator.finalize()
 
 
 def sanity_check(data):
@@ -140,53 +609,561 @@ def sanity_check(data):
         # We have a 0 sum when there are no dependents
     assert min([round(sum(d['pospairs'].values()), 12)==1 for d in data['rels'].values()]) == True
 
+
+# Parser backends: conllu builds full TokenTree objects,
+# fast only reads the ID, UPOS, HEAD and DEPREL columns
+PARSERS = {'conllu': iter_trees_conll, 'fast': iter_arrays_conll}
+
+# Version of the statistics: bump it whenever tree_stats, corpus_stats
+# (or anything changing their output) is modified, so that cached
+# corpora are recomputed
+STATS_VERSION = 3
+
+# Cache manifest, saved alongside the pickles
+MANIFEST = 'manifest.json'
+
+# Suffix of the per-sentence values saved alongside the pickles
+SENTENCES = '.sentences.npz'
+
+# Subdirectory of the accumulator states (outside of the pickles read by vectorize.py)
+STATES = 'states'
+
+# Subdirectory of the statistics per treebank (when a language has several)
+TREEBANKS = 'treebanks'
+
+# UD treebank file names: <language code>_<treebank>-ud-<split>.conllu
+UD_FILE = re.compile(r'^(?P<language>[^_]+)_(?P<treebank>[^-]+)-ud-(?P<split>[^.]+)\.conllu(\.\w+)?$')
+
+
+def treebank_name(file):
+    """Treebank of a corpus file: fr_gsd for fr_gsd-ud-train.conllu (UD convention), the file name otherwise"""
+    match = UD_FILE.match(file)
+    return match['language'] + '_' + match['treebank'] if match else conll_stem(file)
+
+
+def group_corpora(files, mapping=None, ud=False):
+    """
+    Group corpus files by language: according to mapping ({language:
+    [file names or glob patterns]}), or by their UD language code (fr for
+    fr_gsd-ud-train.conllu) with ud. The other files are languages of
+    their own, named after the file.
+    Returns {language: [files]}, both sorted.
+    """
+    groups = {}
+    for file in sorted(files):
+        language = None
+        for lng, patterns in (mapping or {}).items():
+            if any(fnmatch.fnmatch(file, pattern) for pattern in patterns):
+                language = lng
+                break
+        match = UD_FILE.match(file)
+        if language is None and ud and match:
+            language = match['language']
+        groups.setdefault(language or conll_stem(file), []).append(file)
+    return dict(sorted(groups.items()))
+
+
+def process_corpus(lng, path_to_file, outpath, parser='conllu', shards=1, pool=None, profile=False, start=0,
+                   treebanks=False):
+    """
+    Parse a corpus, compute its statistics, check them and pickle them
+    to outpath/<lng>.pickle, the values of each sentence being saved
+    to outpath/<lng>.sentences.npz and the accumulator state (the
+    mergeable totals) to outpath/states/<lng>.pickle. Runs in a worker
+    process with --jobs, or dispatches the corpus (split into shards if
+    shards > 1) to pool if given. With start > 0, the first start bytes of the file are the
+    corpus whose state was saved: only the sentences after them are
+    parsed and added to the state (see --append).
+    path_to_file can also be a list of files (the treebanks of a language,
+    see group_corpora), dispatched to pool and merged; their sentences
+    are numbered in the order of the list. With treebanks, the statistics
+    of each treebank are also saved to outpath/treebanks/<treebank>.pickle.
+    Returns (lng, data, error, profile): error is None or the reason why
+    the corpus was skipped (data is then None), profile holds the timings
+    of the stages (see profiling.py) if asked for, None otherwise.
+    """
+    profile = Profile() if profile else None
+    paths = [path_to_file] if isinstance(path_to_file, str) else list(path_to_file)
+    try:
+        if len(paths) > 1 or treebanks:
+            files = accumulate_files(paths, parser, shards, pool, profile, lng, record=True)
+            accumulator, recorder = CorpusAccumulator(), SentenceRecorder()
+            with timed(profile, 'merge', lng):
+                for partial, partial_recorder in files:
+                    accumulator.merge(partial)
+                    recorder.merge(partial_recorder)
+            if treebanks:
+                save_treebanks(paths, [partial for partial, _ in files], outpath, profile, lng)
+        elif start > 0:
+            with timed(profile, 'load_state', lng):
+                accumulator = load_state(state_path(outpath, lng))
+                recorder = SentenceRecorder.load(os.path.join(outpath, lng + SENTENCES))
+            accumulate(PARSERS[parser](paths[0], start=start), profile, lng, recorder, accumulator)
+        elif shards > 1 or pool is not None:
+            recorder = SentenceRecorder()
+            accumulator = sharded_accumulate(paths[0], parser, shards, pool, profile, lng, recorder)
+        else:
+            recorder = SentenceRecorder()
+            accumulator = accumulate(PARSERS[parser](paths[0]), profile, lng, recorder)
+        with timed(profile, 'finalize', lng):
+            data = accumulator.finalize()
+    except (ParseException, OSError):
+        return lng, None, "can't parse " + ', '.join(os.path.basename(path) for path in paths), profile
+    except ValueError as err:
+        return lng, None, str(err), profile
+    except Exception as err:
+        return lng, None, "can't process the corpus for {} ({}: {})".format(lng, type(err).__name__, err), profile
+
+    try:
+        with timed(profile, 'sanity_check', lng):
+            sanity_check(data)
+    except AssertionError:
+        return lng, None, 'flushing inconsistent data for ' + lng, profile
+
+    fn = os.path.join(outpath, lng + '.pickle')
+    with timed(profile, 'save', lng):
+        with open(fn, 'wb') as f:
+            pickle.dump(data, f)
+        recorder.save(os.path.join(outpath, lng + SENTENCES))
+        save_state(state_path(outpath, lng), accumulator)
+    return lng, data, None, profile
+
+
+def save_treebanks(paths, accumulators, outpath, profile=None, language=None):
+    """
+    Save the statistics of each treebank (see treebank_name) of a language,
+    given the accumulators of its files, to outpath/treebanks/<treebank>.pickle.
+    """
+    os.makedirs(os.path.join(outpath, TREEBANKS), exist_ok=True)
+    merged = {}
+    for path, accumulator in zip(paths, accumulators):
+        merged.setdefault(treebank_name(os.path.basename(path)), CorpusAccumulator()).merge(accumulator)
+    for name, accumulator in merged.items():
+        with timed(profile, 'treebanks', language):
+            data = accumulator.finalize()
+            sanity_check(data)
+            with open(os.path.join(outpath, TREEBANKS, name + '.pickle'), 'wb') as f:
+                pickle.dump(data, f)
+
+
+def state_path(outpath, lng):
+    """Path of the accumulator state of a language: outpath/states/<lng>.pickle"""
+    return os.path.join(outpath, STATES, lng + '.pickle')
+
+
+def save_state(path_to_file, accumulator):
+    """
+    Pickle the state of an accumulator (atomically). Only plain data is
+    pickled (see CorpusAccumulator.state), not the class, so that the
+    state can be loaded whether stats.py runs as a script or a module.
+    """
+    os.makedirs(os.path.dirname(path_to_file), exist_ok=True)
+    with open(path_to_file + '.tmp', 'wb') as f:
+        pickle.dump(accumulator.state(), f)
+    os.replace(path_to_file + '.tmp', path_to_file)
+
+
+def load_state(path_to_file):
+    """Load an accumulator saved by save_state"""
+    with open(path_to_file, 'rb') as f:
+        return CorpusAccumulator.from_state(pickle.load(f))
+
+
+def file_digest(path_to_file, chunk_size=1 << 20, size=None):
+    """SHA-256 of the content of a file (of its first size bytes if given)"""
+    digest = hashlib.sha256()
+    remaining = float('inf') if size is None else size
+    with open(path_to_file, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(digest, **options):
+    """Cache key of a corpus: its content, the stats version and the options"""
+    key = json.dumps({'input': digest, 'version': STATS_VERSION, 'options': options}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
+def load_manifest(outpath):
+    """Load the cache manifest {lng: entry} of outpath (empty if there is none)"""
+    try:
+        with open(os.path.join(outpath, MANIFEST), encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(outpath, manifest):
+    """Save the cache manifest of outpath (atomically)"""
+    fn = os.path.join(outpath, MANIFEST)
+    with open(fn + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+
+def manifest_entry(path_to_file, previous=None, **options):
+    """
+    Manifest entry of a corpus file. The content is only hashed again
+    if its size or modification time differ from the previous entry.
+    """
+    stat = os.stat(path_to_file)
+    entry = {'file': os.path.basename(path_to_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(k) == entry[k] for k in ['file', 'size', 'mtime_ns']):
+        entry['sha256'] = previous['sha256']
+    else:
+        entry['sha256'] = file_digest(path_to_file)
+    entry['key'] = cache_key(entry['sha256'], **options)
+    return entry
+
+
+def group_entry(paths, previous=None, **options):
+    """
+    Manifest entry of a corpus made of several files: the entries of the
+    files (see manifest_entry) and a key combining theirs.
+    """
+    previous_files = (previous or {}).get('files', {})
+    files = {}
+    for path in paths:
+        file = os.path.basename(path)
+        files[file] = manifest_entry(path, previous_files.get(file), **options)
+    key = json.dumps([files[os.path.basename(path)]['key'] for path in paths])
+    return {'files': files, 'key': hashlib.sha256(key.encode('utf8')).hexdigest()}
+
+
+def appended_from(path_to_file, previous, **options):
+    """
+    Size of the previous content of a corpus file if it only grew since
+    its previous manifest entry (computed with the same options and
+    stats version), i.e. where its new sentences start; 0 otherwise.
+    """
+    if not previous or 'sha256' not in previous or previous.get('key') != cache_key(previous['sha256'], **options):
+        return 0
+    if is_compressed(path_to_file): # offsets in the compressed data are meaningless
+        return 0
+    if os.path.getsize(path_to_file) <= previous['size']:
+        return 0
+    if file_digest(path_to_file, size=previous['size']) != previous['sha256']:
+        return 0
+    # The new sentences must start after a blank line
+    size = previous['size']
+    with open(path_to_file, 'rb') as f:
+        f.seek(max(0, size - 4))
+        before = f.read(size - max(0, size - 4)).replace(b'\r', b'')
+        after = f.read(2).replace(b'\r', b'')
+    if not (before.endswith(b'\n\n') or before.endswith(b'\n') and after.startswith(b'\n')):
+        return 0
+    return size
+
+
+# TEST ROUTINES
+# ===================================================================
+
+TEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data-test')
+TEST_FILES = ['test1.conllu', 'test2.conllu', 'fr_ftb-ud-dev.conllu']
+
+def copy_test_files(tmp, files):
+    """Paths of copies of test files in tmp, where the sentence indexes built by sharding are saved"""
+    import shutil
+    return [shutil.copy(os.path.join(TEST_PATH, file), tmp) for file in files]
+
+def same_stats(s1, s2):
+    """Compare two stats dicts (NaN values compare equal)"""
+    return pformat(s1) == pformat(s2)
+
+def sorted_branches(stats):
+    """Sort the branch lists of tree stats (their order is not significant)"""
+    for key in ['rels', 'postags']:
+        for dic in stats[key].values():
+            for k in ['branches', 'length', 'thickness']:
+                dic[k].sort()
+    return stats
+
+def test_parsers():
+    for file in TEST_FILES:
+        path = os.path.join(TEST_PATH, file)
+        assert same_stats(corpus_stats(PARSERS['conllu'](path)), corpus_stats(PARSERS['fast'](path)))
+
+def test_sentence_stats():
+    path = os.path.join(TEST_PATH, 'test1.conllu')
+    for tree, sentence in zip(iter_trees_conll(path), iter_arrays_conll(path)):
+        assert same_stats(sorted_branches(tree_stats(tree)), sorted_branches(sentence_stats(sentence)))
+
+def test_deep_sentence():
+    # A chain of dependents far deeper than Python's recursion limit
+    n = 5000
+    ids = np.arange(1, n+1, dtype=np.int32)
+    sentence = Sentence(ids, ids - 1, np.zeros(n, dtype=np.int16), np.zeros(n, dtype=np.int16), ['X'], ['dep'])
+    stats = sentence_stats(sentence)
+    assert stats['depth'] == n - 1
+    assert stats['hdsum'] == n * (n - 1) // 2
+    assert stats['ddsum'] == 0
+    assert stats['rels']['dep']['right'] == n - 1
+    assert stats['rels']['dep']['pospairs'] == {('ROOT', 'X'): 1, ('X', 'X'): n - 1}
+
+def test_merge():
+    path = os.path.join(TEST_PATH, 'test2.conllu')
+    sentences = list(iter_arrays_conll(path))
+    shards = [CorpusAccumulator() for _ in range(3)]
+    for i, sentence in enumerate(sentences):
+        shards[i % 3].add_tree(sentence)
+    merged = shards[2].merge(shards[0]).merge(shards[1])
+    assert merged.size == len(sentences)
+    assert same_stats(merged.finalize(), corpus_stats(sentences))
+
+def test_describe_hist():
+    rng = np.random.default_rng(0)
+    hists = [{0: 1}, {3: 5}, {0: 1, 1: 1}, {0: 3, 1: 1, 7: 2}, {0.5: 2, 2: 3}]
+    hists += [Counter(rng.poisson(lam, size).tolist()) for lam, size in [(0.3, 10), (1, 101), (4, 5000)]]
+    for hist in hists:
+        d1 = describe_dist(list(Counter(hist).elements()))
+        d2 = describe_hist(hist)
+        for k in d1:
+            assert np.isclose(d1[k], d2[k], rtol=1e-9, atol=1e-12, equal_nan=True), (hist, k, d1[k], d2[k])
+
+def test_shards():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in copy_test_files(tmp, TEST_FILES):
+            for parser in PARSERS:
+                serial = corpus_stats(PARSERS[parser](path))
+                for shards in [2, 3, 7]:
+                    assert same_stats(sharded_corpus_stats(path, parser, shards), serial)
+
+def test_sentence_index():
+    for file in TEST_FILES:
+        path = os.path.join(TEST_PATH, file)
+        with SentenceIndex(path, save=False) as index:
+            sentences = list(iter_sentences_conll(path))
+            assert index[:] == sentences
+            assert index[-1] == sentences[-1]
+            assert index.tokens.tolist() == [len(s.ids) for s in iter_arrays_conll(path)]
+            indices, sample = index.sample(5, seed=0)
+            assert sample == [sentences[i] for i in indices]
+            assert same_stats(corpus_stats(index.arrays(indices)), corpus_stats(index.trees(indices)))
+    # A saved index is not reused for a replaced file, even if the new file is older
+    import shutil, tempfile
+    from conll import load_index
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'xx.conllu')
+        shutil.copy(os.path.join(TEST_PATH, 'test1.conllu'), path)
+        load_index(path)
+        stat = os.stat(path)
+        shutil.copy(os.path.join(TEST_PATH, 'test2.conllu'), path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+        assert same_stats(sharded_corpus_stats(path, 'fast', 3), corpus_stats(iter_arrays_conll(path)))
+
+def test_sentence_recorder():
+    path = os.path.join(TEST_PATH, 'test2.conllu')
+    recorder = SentenceRecorder()
+    serial = accumulate(iter_arrays_conll(path), recorder=recorder).finalize()
+    columns = recorder.columns()
+    assert columns['id'].tolist() == list(range(len(recorder)))
+    assert columns['weight'].sum() == sum(len(s.ids) for s in iter_arrays_conll(path))
+    assert np.isclose(columns['mdd'].mean(), serial['mdd'])
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        [path] = copy_test_files(tmp, ['test2.conllu'])
+        for shards in [2, 3]:
+            sharded = SentenceRecorder()
+            sharded_corpus_stats(path, 'fast', shards, recorder=sharded)
+            for k, v in sharded.columns().items():
+                assert np.array_equal(v, columns[k]) and v.dtype == columns[k].dtype
+
+def test_coverage():
+    path = os.path.join(TEST_PATH, 'test1.conllu')
+    sentences = [sentence_stats(s) for s in iter_arrays_conll(path)]
+    data = corpus_stats(iter_arrays_conll(path))
+    assert data['rels']['root']['coverage'] == 1
+    for key in ['rels', 'postags']:
+        for label, dic in data[key].items():
+            assert dic['coverage'] == sum(label in s[key] for s in sentences) / len(sentences)
+    for pair, coverage in data['pospairs'].items():
+        assert coverage == sum(any(pair in d['pospairs'] for d in s['rels'].values()) for s in sentences) / len(sentences)
+
+def test_append():
+    import tempfile
+    with open(os.path.join(TEST_PATH, 'test2.conllu'), encoding='utf8') as f:
+        text = f.read()
+    cut = text.index('\n\n', len(text) // 2) + 2
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'xx.conllu')
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(text[:cut])
+        previous = manifest_entry(path, parser='fast')
+        process_corpus('xx', path, tmp, 'fast')
+        with open(path, 'a', encoding='utf8') as f:
+            f.write(text[cut:])
+        start = appended_from(path, previous, parser='fast')
+        assert start == len(text[:cut].encode('utf8'))
+        assert appended_from(path, previous, parser='conllu') == 0
+        _, data, error, _ = process_corpus('xx', path, tmp, 'fast', start=start)
+        assert error is None
+        recorder = SentenceRecorder()
+        assert same_stats(data, accumulate(iter_arrays_conll(path), recorder=recorder).finalize())
+        for k, v in load_sentences(os.path.join(tmp, 'xx' + SENTENCES)).items():
+            assert np.array_equal(v, recorder.columns()[k])
+        # The state is plain data, and is not mistaken for a corpus by vectorize.py
+        with open(state_path(tmp, 'xx'), 'rb') as f:
+            assert type(pickle.load(f)) is dict
+        assert sorted(f for f in os.listdir(tmp) if f.endswith('.pickle')) == ['xx.pickle']
+
+def test_groups():
+    files = ['fr_gsd-ud-train.conllu', 'fr_gsd-ud-dev.conllu', 'fr_ftb-ud-test.conllu', 'en_ewt-ud-train.conllu', 'test1.conllu']
+    assert group_corpora(files, ud=True) == {'en': ['en_ewt-ud-train.conllu'], 'fr': sorted(files[:3]), 'test1': ['test1.conllu']}
+    assert group_corpora(files, {'French': ['fr_*'], 'Test': ['test1.conllu']}) == {
+        'French': sorted(files[:3]), 'Test': ['test1.conllu'], 'en_ewt-ud-train': ['en_ewt-ud-train.conllu']}
+    assert treebank_name('fr_gsd-ud-dev.conllu') == 'fr_gsd' and treebank_name('test1.conllu') == 'test1'
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = copy_test_files(tmp, ['test1.conllu', 'test2.conllu'])
+        _, data, error, _ = process_corpus('xx', paths, tmp, 'fast', shards=2, treebanks=True)
+        assert error is None
+        assert same_stats(data, corpus_stats(itertools.chain(*(iter_arrays_conll(path) for path in paths))))
+        with open(os.path.join(tmp, TREEBANKS, 'test2.pickle'), 'rb') as f:
+            assert same_stats(pickle.load(f), corpus_stats(iter_arrays_conll(paths[1])))
+        ids = load_sentences(os.path.join(tmp, 'xx' + SENTENCES))['id']
+        assert ids.tolist() == list(range(sum(1 for path in paths for _ in iter_arrays_conll(path))))
+
+def test_compressed():
+    import gzip, lzma, tempfile
+    import conll
+    path = os.path.join(TEST_PATH, 'test1.conllu')
+    with open(path, 'rb') as f:
+        content = f.read()
+    serial = corpus_stats(iter_arrays_conll(path))
+    with tempfile.TemporaryDirectory() as tmp:
+        writers = {'.gz': gzip.compress, '.xz': lzma.compress}
+        if conll.zstandard is not None:
+            writers['.zst'] = conll.zstandard.ZstdCompressor().compress
+        for suffix, compress in writers.items():
+            compressed = os.path.join(tmp, 'test1.conllu' + suffix)
+            with open(compressed, 'wb') as f:
+                f.write(compress(content))
+            assert list(iter_sentences_conll(compressed)) == list(iter_sentences_conll(path))
+            for parser in PARSERS:
+                assert same_stats(corpus_stats(PARSERS[parser](compressed)), corpus_stats(PARSERS[parser](path)))
+            [(accumulator, _)] = accumulate_files([compressed], 'fast', shards=3) # read as a whole
+            assert same_stats(accumulator.finalize(), serial)
+            assert conll.load_conll(compressed) == conll.load_conll(path)
+            assert conll_stem(os.path.basename(compressed)) == 'test1'
+            assert conll_files(['test1.conllu' + suffix, 'test1.conllu', 'x.txt']) == ['test1.conllu']
+            try:
+                conll.load_index(compressed)
+                assert False, 'compressed files cannot be indexed'
+            except ValueError:
+                pass
+        assert conll_files(['test1.conllu.xz', 'test1.conllu.gz']) == ['test1.conllu.gz']
+        # Stopping early does not leave the decompression thread blocked
+        next(iter_arrays_conll(os.path.join(tmp, 'test1.conllu.gz')))
+
+
+def test():
+    test_parsers()
+    test_sentence_stats()
+    test_deep_sentence()
+    test_merge()
+    test_describe_hist()
+    test_shards()
+    test_sentence_index()
+    test_sentence_recorder()
+    test_coverage()
+    test_append()
+    test_groups()
+    test_compressed()
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Get statistics for each corpus.')
     parser.add_argument('-i', '--inpath', default='data-test/', help='path where the corpora reside')
     parser.add_argument('-o', '--outpath', default='data-test/', help='path where the statistics should be saved')
+    parser.add_argument('-p', '--parser', default='conllu', choices=sorted(PARSERS), help='parser backend (fast only reads the columns needed)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of corpora (or shards) processed in parallel')
+    parser.add_argument('-s', '--shards', type=int, default=1, help='split each corpus into shards processed in parallel')
+    parser.add_argument('--profile', metavar='REPORT', help='save the time and memory used per stage and per language to this JSON file')
+    parser.add_argument('-a', '--append', action='store_true', help='only process the new sentences of the corpora that grew (appended sentences)')
+    parser.add_argument('-g', '--groups', metavar='MAPPING', help='JSON file mapping languages to their corpus files (names or glob patterns)')
+    parser.add_argument('--ud', action='store_true', help='group the corpus files by UD language code (fr for fr_gsd-ud-train.conllu)')
+    parser.add_argument('-t', '--treebanks', action='store_true', help='also save the statistics of each treebank of a language in <outpath>/treebanks/')
     args = parser.parse_args()
     UD_PATH = args.inpath
     DATA_PATH = args.outpath
 
-    files = sorted([f for f in os.listdir(UD_PATH) if f.endswith('.conllu')])
-    languages = [f[:-7] for f in files]
-    pickled = [f for f in os.listdir(DATA_PATH) if f.endswith('.pickle')]
-    done = [f[:-7] for f in pickled]
+    # Plain or compressed files, one per corpus
+    listing = os.listdir(UD_PATH)
+    files = conll_files(listing)
+    chosen = {conll_stem(f): f for f in files}
+    for f in sorted(set(filter(is_conll_file, listing)) - set(files)):
+        print('  SKIPPING: {} (same corpus as {})'.format(f, chosen[conll_stem(f)]))
+    mapping = None
+    if args.groups:
+        with open(args.groups, encoding='utf8') as f:
+            mapping = json.load(f)
+    groups = group_corpora(files, mapping, args.ud)
+    languages = list(groups)
 
-    with open(DATA_PATH + 'data.txt', 'w', encoding='utf8') as d:
-        for file, lng in zip(files, languages):
+    profile = Profile() if args.profile else None
 
-            if lng in done:
-                continue
+    # Only process the corpora whose content or statistics changed
+    manifest = load_manifest(DATA_PATH)
+    entries = {}
+    todo = []
+    for lng, group in groups.items():
+        paths = [UD_PATH + file for file in group]
+        with timed(profile, 'manifest', lng):
+            if len(paths) == 1:
+                entries[lng] = manifest_entry(paths[0], manifest.get(lng), parser=args.parser)
+            else:
+                entries[lng] = group_entry(paths, manifest.get(lng), parser=args.parser)
+        cached = manifest.get(lng, {}).get('key') == entries[lng]['key']
+        saved = all(os.path.exists(fn) for fn in [DATA_PATH + lng + '.pickle', DATA_PATH + lng + SENTENCES,
+                                                  state_path(DATA_PATH, lng)])
+        if args.treebanks:
+            saved = saved and all(os.path.exists(os.path.join(DATA_PATH, TREEBANKS, treebank_name(file) + '.pickle'))
+                                  for file in group)
+        if not cached or not saved:
+            # Corpora that only grew are updated from their saved state
+            start = 0
+            if args.append and saved and len(paths) == 1 and not args.treebanks:
+                start = appended_from(paths[0], manifest.get(lng), parser=args.parser)
+            todo.append((lng, paths if len(paths) > 1 else paths[0], start))
 
-            print('Processing', lng)
+    with open(DATA_PATH + 'data.txt', 'w', encoding='utf8') as d:
+        with ProcessPoolExecutor(args.jobs) if args.jobs > 1 else nullcontext() as pool, \
+             ThreadPoolExecutor(2 * args.jobs) as threads:
+            # Results come back in language order, whatever the number of jobs
+            if pool and (args.shards > 1 or any(len(group) > 1 for group in groups.values())):
+                # The corpora are handled by threads of this process, each one dispatching its
+                # files and shards to the pool: those of all the corpora are queued at once
+                run, dispatch = threads.map, pool
+            else:
+                run, dispatch = pool.map if pool else map, None
+            results = run(process_corpus, [lng for lng, _, _ in todo], [path for _, path, _ in todo],
+                          itertools.repeat(DATA_PATH), itertools.repeat(args.parser), itertools.repeat(args.shards),
+                          itertools.repeat(dispatch), itertools.repeat(bool(args.profile)),
+                          [start for _, _, start in todo], itertools.repeat(args.treebanks))
+            for (lng, data, error, corpus_profile), (_, _, start) in zip(results, todo):
 
-            try:
-                corpus = parse_tree_conll(UD_PATH + file)
-            except:
-                print("  SKIPPING: can't parse", file)
-                continue
+                print('Processing', lng)
+                if start:
+                    print('  APPENDING: sentences after byte', start)
+                if profile is not None and corpus_profile is not None:
+                    profile.extend(corpus_profile)
 
-            try:
-                data = corpus_stats(corpus)
-            except ValueError as err:
-                print('  SKIPPING: '+str(err))
-                continue
-            except:
-                print("  SKIPPING: can't process the corpus for", lng)
-                continue
+                if error is not None:
+                    print('  SKIPPING: ' + error)
+                    continue
 
-            try:
-                sanity_check(data)
-            except:
-                print("  SKIPPING: flushing inconsistent data for", lng)
-                continue
+                manifest[lng] = entries[lng]
+                save_manifest(DATA_PATH, manifest)
 
-            fn = DATA_PATH + lng + '.pickle'
-            with open(fn, 'wb') as f:
-                pickle.dump(data, f)
+                print(lng, file=d)
+                pprint(data, stream=d)
+                print('\n', file=d)
 
-            print(lng, file=d)
-            pprint(data, stream=d)
-            print('\n', file=d)
+    if args.profile:
+        profile.save(args.profile)
@@ -5,7 +5,9 @@
 import numpy as np
 from pprint import pprint
 from scipy import stats
+import scipy.sparse
 import os
+import json
 import argparse
 import pickle
 from collections import OrderedDict as od
@@ -13,6 +15,7 @@ import itertools
 
 # ---- Project libraries -------------------------------------------------------
 import dictutils as du
+from profiling import Profile, timed
 
 
 def normalize(corpora):
@@ -24,13 +27,17 @@ def normalize(corpora):
     Returns:
         None, but dictionaries are modified in situ!
     """
-    zero_dict = {'freq': 0, 'branches': {'left': 0, 'right': 0, 'dist': {'kurtosis': 0, 'mean': 0, 'median': 0, 'range': 0, 'skew': 0, 'std': 0}}}
+    zero_dist = {'kurtosis': 0, 'mean': 0, 'median': 0, 'range': 0, 'skew': 0, 'std': 0}
+    zero_dict = {'freq': 0, 'coverage': 0, 'branches': {'left': 0, 'right': 0, 'dist': zero_dist}, 'length': zero_dist, 'thickness': zero_dist}
     for key in ['postags', 'rels']: # order is important!
         labels = du.keyset([corpus[key] for corpus in corpora]) # set of relations or postags
         for corpus in corpora:
             for label in labels:
                 if label not in corpus[key].keys():
                     corpus[key][label] = dict(zero_dict) # make sure it's a fresh copy!
+                else: # corpora computed before some values were added (see stats.STATS_VERSION)
+                    for k, v in zero_dict.items():
+                        corpus[key][label].setdefault(k, v)
             # Sanity check
             try:
                 min([k in labels for k in corpus[key].keys()]) == True
@@ -56,6 +63,11 @@ def normalize(corpora):
                 assert rel in labels
             except:
                 raise Exception("ERROR: parasitic rel " + rel)
+    # Coverage of the POS pairs
+    for corpus in corpora:
+        for pair in pospairs:
+            corpus.setdefault('pospairs', {}).setdefault(pair, 0)
+
     # Sanity check
     k = [sorted(list(d['pospairs'].keys()) )for corpus in corpora for d in corpus['rels'].values()]
     k.sort()
@@ -65,46 +77,170 @@ def normalize(corpora):
         raise Exception("ERROR: couldn't normalize POS pairs")
 
 
+def save_matrix(name, matrix, labels, columns=None):
+    """
+    Save a (corpora x features) matrix in a compact binary format:
+    <name>.f32 holds the float32 values (row by row) and <name>.json
+    the shape, the row labels (languages) and the column names.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    matrix.tofile(name + '.f32')
+    index = {'shape': list(matrix.shape), 'dtype': 'float32', 'labels': list(labels),
+             'columns': None if columns is None else list(columns)}
+    with open(name + '.json', 'w', encoding='utf8') as f:
+        json.dump(index, f)
+
+
+def load_matrix(name):
+    """
+    Open a matrix saved by save_matrix. The values are memory-mapped
+    (read-only), not read or copied.
+    Returns (matrix, labels, columns).
+    """
+    with open(name + '.json', encoding='utf8') as f:
+        index = json.load(f)
+    matrix = np.memmap(name + '.f32', dtype=index['dtype'], mode='r', shape=tuple(index['shape']))
+    return matrix, index['labels'], index['columns']
+
+
+def convert_pickle(path_to_file):
+    """
+    Convert pickled vectors (a zip of (language, vector) pairs, or a dict)
+    to the compact format, with the same name. Returns the new name.
+    """
+    with open(path_to_file, 'rb') as f:
+        vectors = pickle.load(f)
+    pairs = list(vectors.items() if isinstance(vectors, dict) else vectors)
+    if len({len(v) for _, v in pairs}) != 1:
+        raise ValueError('vectors are not of equal lengths:\n' + str([len(v) for _, v in pairs]))
+    name = os.path.splitext(path_to_file)[0]
+    save_matrix(name, np.vstack([v for _, v in pairs]), [lng for lng, _ in pairs])
+    return name
+
+
+class VectorStore:
+    """
+    Persisted vectors, so that corpora can be added or updated without
+    vectorizing the whole collection again. The directory holds an
+    append-only feature schema (columns.json) and one vector per corpus
+    (rows/<language>.npy). A corpus is projected onto the existing columns;
+    features never seen before are appended as new columns, which are
+    implicitly 0 for the vectors written before (shorter rows are padded).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, 'rows'), exist_ok=True)
+        columns = os.path.join(path, 'columns.json')
+        self.schema = du.FeatureSchema.load(columns) if os.path.exists(columns) else du.FeatureSchema()
+
+    def row_file(self, language):
+        return os.path.join(self.path, 'rows', language + '.npy')
+
+    @property
+    def languages(self):
+        return sorted(f[:-4] for f in os.listdir(os.path.join(self.path, 'rows')) if f.endswith('.npy'))
+
+    def add(self, language, corpus):
+        """Adds (or replaces) the vector of a corpus; only its row is written"""
+        if self.schema.extend([corpus]):
+            # The schema is saved before the row, so rows are never longer
+            self.schema.save(os.path.join(self.path, 'columns.json'))
+        np.save(self.row_file(language), self.schema.vector(corpus))
+
+    def is_outdated(self, language, path_to_file):
+        """Tells whether the vector of a corpus is missing or older than its stats file"""
+        row = self.row_file(language)
+        return not os.path.exists(row) or os.path.getmtime(row) < os.path.getmtime(path_to_file)
+
+    def row(self, language):
+        vector = np.load(self.row_file(language))
+        return np.pad(vector, (0, len(self.schema) - len(vector)))
+
+    def matrix(self, languages=None):
+        """Returns the (languages x features) matrix (all languages by default)"""
+        languages = self.languages if languages is None else languages
+        matrix = np.zeros((len(languages), len(self.schema)))
+        for lng, row in zip(languages, matrix):
+            vector = np.load(self.row_file(lng))
+            row[:len(vector)] = vector
+        return matrix
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Vectorize corpora statistics.')
     parser.add_argument('-i', '--inpath', default='data/', help='path where the corpora statistics reside')
     parser.add_argument('-o', '--outpath', default='data-test/', help='path where the vectorized data should be saved')
+    parser.add_argument('-f', '--format', default='dense', choices=['dense', 'sparse'],
+                        help='dense: normalized vectors-all.pickle, sparse: CSR matrix vectors-all.npz')
+    parser.add_argument('-s', '--store', help='only add new or updated corpora to the vector store in this directory')
+    parser.add_argument('-c', '--convert', help='convert pickled vectors to the compact format and exit')
+    parser.add_argument('--profile', metavar='REPORT', help='save the time and memory used per stage (and per language) to this JSON file')
     args = parser.parse_args()
     INPATH = args.inpath
     OUTPATH = args.outpath
+    profile = Profile() if args.profile else None
 
     files = sorted([f for f in os.listdir(INPATH) if f.endswith('.pickle')])
     languages = [f[:-7] for f in files]
 
-    # Each pickle is a dict
-    corpora = [pickle.load(open(INPATH + file, 'rb')) for file in files]
+    if args.convert:
+        print('Saved', convert_pickle(args.convert) + '.f32')
+    elif args.store:
+        store = VectorStore(args.store)
+        for file, lng in zip(files, languages):
+            if store.is_outdated(lng, INPATH + file):
+                print('Vectorizing', lng)
+                with timed(profile, 'load', lng):
+                    corpus = pickle.load(open(INPATH + file, 'rb'))
+                with timed(profile, 'add', lng):
+                    store.add(lng, corpus)
+    else:
+        # Each pickle is a dict
+        corpora = []
+        for file, lng in zip(files, languages):
+            with timed(profile, 'load', lng):
+                corpora.append(pickle.load(open(INPATH + file, 'rb')))
 
-    # Normalize
-    normalize(corpora) # dictionaries are modified in situ
+        if args.format == 'dense':
+            # Normalize
+            with timed(profile, 'normalize', corpora=len(corpora)):
+                normalize(corpora) # dictionaries are modified in situ
 
-    # Sanity check
-    try:
-        assert len({du.count_values(c) for c in corpora}) == 1
-    except:
-        for i, c in enumerate(corpora, 1):
-            with open(OUTPATH + 'debug-corpus-{}.txt'.format(i), 'w') as f:
-                pprint(c, f)
-        raise Exception('ERROR: did not normalize properly, numbers of values differ:\n' + str([du.count_values(c) for c in corpora]))
+            # Sanity check
+            try:
+                assert len({du.count_values(c) for c in corpora}) == 1
+            except:
+                for i, c in enumerate(corpora, 1):
+                    with open(OUTPATH + 'debug-corpus-{}.txt'.format(i), 'w') as f:
+                        pprint(c, f)
+                raise Exception('ERROR: did not normalize properly, numbers of values differ:\n' + str([du.count_values(c) for c in corpora]))
 
-    # Vectorize
-    vectors = du.to_vectors(corpora)
+        # Vectorize (one row per corpus, one column per feature of the schema)
+        # Without normalization, the schema only has the features seen in some corpus
+        with timed(profile, 'schema'):
+            schema = du.FeatureSchema.from_dicts(corpora)
+        with timed(profile, 'vectorize', corpora=len(corpora), features=len(schema)):
+            vectors = schema.matrix(corpora) if args.format == 'dense' else schema.sparse(corpora)
 
-    # Sanity check
-    try:
-        assert len(vectors) == len(languages)
-    except:
-        raise Exception('ERROR: number of vectors and number of languages are not equal')
-    try:
-        assert len({len(v) for v in vectors}) == 1
-    except:
-        raise Exception('ERROR: vectors are not of equal lengths:\n' + str([len(v) for v in vectors]))
+        # Sanity check
+        try:
+            assert vectors.shape[0] == len(languages)
+        except:
+            raise Exception('ERROR: number of vectors and number of languages are not equal')
+
+        with timed(profile, 'save'):
+            if args.format == 'dense':
+                fn = OUTPATH + 'vectors-all.pickle'
+                with open(fn, 'wb') as f:
+                    pickle.dump(zip(languages, vectors), f)
+                save_matrix(OUTPATH + 'vectors-all', vectors, languages, schema.names) # memory-mappable copy
+            else:
+                scipy.sparse.save_npz(OUTPATH + 'vectors-all.npz', vectors)
+                with open(OUTPATH + 'vectors-all-rows.json', 'w', encoding='utf8') as f:
+                    json.dump(languages, f)
+            schema.save(OUTPATH + 'vectors-all-columns.json') # feature names
 
-    fn = OUTPATH + 'vectors-all.pickle'
-    with open(fn, 'wb') as f:
-        pickle.dump(zip(languages, vectors), f)
+    if args.profile:
+        profile.save(args.profile)